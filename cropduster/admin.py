@@ -1,5 +1,5 @@
 from django.contrib import admin
-from cropduster.models import Size, SizeSet
+from cropduster.models import EncodingProfile, Size, SizeSet
 from django.conf import settings
 
 class SizeInline(admin.TabularInline):
@@ -14,6 +14,9 @@ class SizeInline(admin.TabularInline):
 				'width', 
 				'height', 
 				'auto_size',
+				'create_on_request',
+				'encoding_profile',
+				'max_bytes',
 				'size_set', 
 				'aspect_ratio',
 			)
@@ -29,4 +32,8 @@ class SizeSetAdmin(admin.ModelAdmin):
 		SizeInline,
 	]
 
-admin.site.register(SizeSet, SizeSetAdmin)
\ No newline at end of file
+class EncodingProfileAdmin(admin.ModelAdmin):
+	list_display = ('name', 'format', 'quality', 'progressive', 'optimize', 'strip_metadata')
+
+admin.site.register(SizeSet, SizeSetAdmin)
+admin.site.register(EncodingProfile, EncodingProfileAdmin)
\ No newline at end of file
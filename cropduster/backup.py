@@ -0,0 +1,49 @@
+"""
+Manifests for the archives written by the backup_images command.
+
+Every archive ends with a member named MANIFEST_NAME (also written next to the
+archive, as <archive>.manifest) listing every image file the backup covered,
+one per line:
+
+	kind	size	mtime	sha1	path
+
+where kind is "original" or "derived". Incremental backups only archive the
+files that changed since a previous manifest, but their manifest still lists
+everything, so it can be used as the base of the next one.
+"""
+import hashlib
+from collections import namedtuple
+
+MANIFEST_NAME = "cropduster.manifest"
+
+ORIGINAL = "original"
+DERIVED = "derived"
+
+Entry = namedtuple("Entry", ("kind", "size", "mtime", "sha1", "path"))
+
+def hash_file(path, block_size=1 << 20):
+	""" Returns the sha1 hex digest of a file's contents """
+	sha1 = hashlib.sha1()
+	f = open(path, "rb")
+	try:
+		for block in iter(lambda: f.read(block_size), ""):
+			sha1.update(block)
+	finally:
+		f.close()
+	return sha1.hexdigest()
+
+def format_entry(entry):
+	return u"%s\t%d\t%d\t%s\t%s\n" % entry
+
+def read_manifest(lines):
+	""" Parses manifest lines, returning the entries by path """
+	entries = {}
+	for line in lines:
+		if isinstance(line, str):
+			line = line.decode("utf8")
+		line = line.rstrip("\n")
+		if not line:
+			continue
+		kind, size, mtime, sha1, path = line.split("\t", 4)
+		entries[path] = Entry(kind, int(size), int(mtime), sha1, path)
+	return entries
@@ -0,0 +1,67 @@
+"""
+Looking up the thumbnails of many objects at once, for list pages.
+"""
+from cropduster.models import CropDusterField, Image
+from cropduster.registry import registry
+
+
+def get_image_field(model, field_name=None):
+	""" Returns the named CropDusterField of a model, or its first one """
+	if field_name:
+		return model._meta.get_field(field_name)
+	for field in model._meta.fields:
+		if isinstance(field, CropDusterField):
+			return field
+	raise ValueError("%s has no CropDusterField" % model.__name__)
+
+def prefetch_images(objects, field_name=None):
+	"""
+	Loads the cropduster images of a list of objects with one query, and
+	stores each on its object so that accessing the field doesn't query again.
+	Each image's size set is set from the registry. Objects can also be
+	cropduster images themselves.
+
+	Returns the images, in the same order as the objects, with None for
+	objects that have none.
+	"""
+	objects = list(objects)
+	if not objects:
+		return []
+
+	if isinstance(objects[0], Image):
+		images = objects
+	else:
+		field = get_image_field(objects[0].__class__, field_name)
+		cache_name = field.get_cache_name()
+
+		missing = set(getattr(obj, field.attname) for obj in objects if not hasattr(obj, cache_name))
+		missing.discard(None)
+		loaded = Image.objects.in_bulk(missing) if missing else {}
+
+		images = []
+		for obj in objects:
+			if not hasattr(obj, cache_name):
+				setattr(obj, cache_name, loaded.get(getattr(obj, field.attname)))
+			images.append(getattr(obj, cache_name))
+
+	size_set_cache = Image._meta.get_field("size_set").get_cache_name()
+	for image in images:
+		if image is not None and not hasattr(image, size_set_cache):
+			setattr(image, size_set_cache, registry.get_size_set(image.size_set_id))
+	return images
+
+def get_thumbnails(objects, size_slug, field_name=None):
+	"""
+	Returns a (url, width, height) tuple for each object's thumbnail of the
+	given size, in the same order as the objects, with None for objects that
+	have no image or whose size set has no such size. Costs at most one query,
+	whatever the number of objects.
+	"""
+	thumbnails = []
+	for image in prefetch_images(objects, field_name):
+		size = image and registry.get_size(image.size_set_id, size_slug)
+		if size is None or not image.image:
+			thumbnails.append(None)
+		else:
+			thumbnails.append((image.thumbnail_url(size_slug), size.width, size.height))
+	return thumbnails
@@ -0,0 +1,128 @@
+"""
+Chunked, resumable uploads of originals.
+
+An upload is started with init(), which returns its id. Its chunks are then
+appended in order, each at the offset the upload has reached; after a dropped
+connection the client asks for the offset and carries on from there. Chunks are
+written straight to a file in CROPDUSTER_CHUNKED_UPLOAD_DIR, and once the whole
+file is there, get_file() hands it over as an uploaded file. Storage moves that
+into place rather than copying it, when it is given the file itself.
+"""
+import fcntl
+import os
+import time
+import uuid
+
+from django.core.files.uploadedfile import UploadedFile
+from django.utils import simplejson
+
+from cropduster.settings import CHUNKED_UPLOAD_DIR, CHUNKED_UPLOAD_EXPIRY, MAX_UPLOAD_BYTES
+
+
+class UploadError(Exception):
+	pass
+
+
+class ChunkedUploadFile(UploadedFile):
+	""" An upload assembled on disk from its chunks """
+
+	def __init__(self, path, name, size):
+		super(ChunkedUploadFile, self).__init__(open(path, "rb"), name, None, size, None)
+		self.path = path
+
+	def temporary_file_path(self):
+		return self.path
+
+
+def _path(upload_id, suffix):
+	return os.path.join(CHUNKED_UPLOAD_DIR, upload_id + suffix)
+
+def remove_stale():
+	""" Removes the files of uploads that haven't had a chunk for a while """
+	expired = time.time() - CHUNKED_UPLOAD_EXPIRY
+	for file_name in os.listdir(CHUNKED_UPLOAD_DIR):
+		path = os.path.join(CHUNKED_UPLOAD_DIR, file_name)
+		try:
+			if os.path.getmtime(path) < expired:
+				os.remove(path)
+		except OSError:
+			pass
+
+def init(name, size, **fields):
+	"""
+	Starts an upload of a file with the given name and size in bytes. Any
+	other fields are kept, to build the image with at the end. Returns the
+	upload's id.
+	"""
+	if size <= 0:
+		raise UploadError("Expected the size of the file")
+	if MAX_UPLOAD_BYTES and size > MAX_UPLOAD_BYTES:
+		raise UploadError("Uploaded file is larger than %i MB" % (MAX_UPLOAD_BYTES / (1024 * 1024)))
+
+	if not os.path.isdir(CHUNKED_UPLOAD_DIR):
+		os.makedirs(CHUNKED_UPLOAD_DIR)
+	remove_stale()
+
+	upload_id = uuid.uuid4().hex
+	with open(_path(upload_id, ".json"), "w") as f:
+		simplejson.dump(dict(fields, name=name, size=size), f)
+	open(_path(upload_id, ".part"), "wb").close()
+	return upload_id
+
+def get_info(upload_id):
+	""" Returns what the upload was started with, or None if it doesn't exist """
+	try:
+		with open(_path(upload_id, ".json")) as f:
+			return simplejson.load(f)
+	except IOError:
+		return None
+
+def get_offset(upload_id):
+	""" Returns the number of bytes received so far """
+	return os.path.getsize(_path(upload_id, ".part"))
+
+def append(upload_id, offset, stream, length, block_size=64 * 1024):
+	"""
+	Writes length bytes read from stream to the upload, if it has reached
+	offset. Returns the new offset.
+	"""
+	info = get_info(upload_id)
+	if info is None:
+		raise UploadError("No such upload")
+
+	with open(_path(upload_id, ".part"), "ab") as f:
+		# Retries of the same chunk can arrive together; the lock, held until
+		# the file is closed, lets only the first of them append it
+		fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+		f.seek(0, os.SEEK_END)
+		if f.tell() != offset:
+			raise UploadError("Upload is at offset %i" % f.tell())
+		if offset + length > info["size"]:
+			raise UploadError("Chunk runs past the end of the file")
+
+		remaining = length
+		while remaining:
+			block = stream.read(min(block_size, remaining))
+			if not block:
+				break
+			f.write(block)
+			remaining -= len(block)
+		return f.tell()
+
+def get_file(upload_id):
+	""" Returns the complete upload as an uploaded file """
+	info = get_info(upload_id)
+	if info is None:
+		raise UploadError("No such upload")
+	offset = get_offset(upload_id)
+	if offset != info["size"]:
+		raise UploadError("Upload is at offset %i of %i" % (offset, info["size"]))
+	return ChunkedUploadFile(_path(upload_id, ".part"), info["name"], info["size"])
+
+def remove(upload_id):
+	""" Removes what is left of an upload """
+	for suffix in (".json", ".part"):
+		try:
+			os.remove(_path(upload_id, suffix))
+		except OSError:
+			pass
@@ -0,0 +1,114 @@
+"""
+Writing thumbnails safely when several threads or processes may be at it.
+
+save_image() writes to a temporary file in the destination's folder, syncs
+it and renames it into place, so a thumbnail is never seen half written.
+locked() holds an exclusive lock for each of a set of thumbnail paths, on a
+lock file in CROPDUSTER_LOCK_DIR; code that creates thumbnails takes the locks
+first and then checks again whether the thumbnails are still out of date, so
+that requests, job workers and regenerate_thumbs don't create the same
+thumbnail twice. The locks are flock()s, which only cover the processes of one
+machine.
+"""
+import errno
+import fcntl
+import hashlib
+import os
+import tempfile
+from contextlib import contextmanager
+
+from PIL import Image
+
+from cropduster import utils
+from cropduster.settings import LOCK_DIR
+
+
+def makedirs(path):
+	""" Creates a folder and any missing parents, unless it already exists """
+	try:
+		os.makedirs(path)
+	except OSError, e:
+		if e.errno != errno.EEXIST:
+			raise
+
+_umask = os.umask(0)
+os.umask(_umask)
+
+def get_format(path):
+	""" The PIL format that goes with a path's extension """
+	Image.init()
+	return Image.EXTENSION[os.path.splitext(path)[1].lower()]
+
+def save_image(img, path, format=None, **params):
+	"""
+	Saves a PIL image to path atomically, in the format given or else the one
+	that goes with path's extension. Returns the size of the file in bytes.
+	"""
+	return _write(path, lambda f: img.save(f, format or get_format(path), **params))
+
+def save_thumbnail(img, format, path, size, profile):
+	"""
+	Encodes a thumbnail with an encoding profile and saves it to path, within
+	the size's max_bytes if it has one. format is the one it is saved in
+	without the profile, or None to go by path's extension.
+
+	@return: (the size of the file in bytes, the quality it was saved at or
+	         None for formats without one)
+	"""
+	img, format, params = profile.prepare(img, format)
+	format = format or get_format(path)
+	if size.max_bytes:
+		data, quality = utils.encode_within(img, format, size.max_bytes, **params)
+		return save_data(data, path), quality
+	filesize = save_image(img, path, format, **params)
+	return filesize, params["quality"] if format in utils.QUALITY_FORMATS else None
+
+def save_data(data, path):
+	""" Writes a string to path atomically. Returns its length. """
+	return _write(path, lambda f: f.write(data))
+
+def _write(path, write):
+	folder, file_name = os.path.split(path)
+	fd, tmp_path = tempfile.mkstemp(prefix="." + file_name + ".", suffix=".tmp", dir=folder)
+	try:
+		f = os.fdopen(fd, "wb")
+		try:
+			write(f)
+			f.flush()
+			os.fsync(f.fileno())
+			filesize = f.tell()
+		finally:
+			f.close()
+		# mkstemp only lets the owner read the file
+		os.chmod(tmp_path, 0666 & ~_umask)
+		os.rename(tmp_path, path)
+	except:
+		try:
+			os.remove(tmp_path)
+		except OSError:
+			pass
+		raise
+	return filesize
+
+def _lock_path(path):
+	return os.path.join(LOCK_DIR, hashlib.md5(os.path.abspath(path).encode("utf8")).hexdigest() + ".lock")
+
+@contextmanager
+def locked(paths):
+	"""
+	Holds an exclusive lock on each of the paths while the block runs,
+	waiting for whoever holds them. They are taken in sorted order, so two
+	holders of overlapping sets can't deadlock. Taking the same path twice
+	while holding it blocks forever, even in the same thread.
+	"""
+	makedirs(LOCK_DIR)
+	files = []
+	try:
+		for path in sorted(set(paths)):
+			f = open(_lock_path(path), "a")
+			files.append(f)
+			fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+		yield
+	finally:
+		for f in reversed(files):
+			f.close()
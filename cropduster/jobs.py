@@ -0,0 +1,226 @@
+"""
+Thumbnail creation jobs.
+
+Image.save() and Crop.save() don't create thumbnails themselves, they enqueue
+a job with the backend named by the CROPDUSTER_JOB_BACKEND setting:
+
+	cropduster.jobs.ImmediateBackend (default)
+		Runs the job straight away in the saving thread.
+
+	cropduster.jobs.ThreadBackend, cropduster.jobs.ProcessBackend
+		Run jobs in a pool of CROPDUSTER_JOB_WORKERS threads or processes
+		belonging to the current process.
+
+	cropduster.jobs.DatabaseBackend
+		Stores jobs in the cropduster_job table, to be run by the
+		cropduster_worker management command.
+"""
+import datetime
+import logging
+import threading
+import traceback
+import uuid
+from multiprocessing.pool import Pool, ThreadPool
+
+from django.db import connection
+from django.utils.importlib import import_module
+
+from cropduster.settings import JOB_BACKEND, JOB_WORKERS
+
+# Tasks
+CROP = "crop"
+IMAGE = "image"
+CROPS = "crops"
+
+# Job statuses
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+def run_task(task, object_id):
+	"""
+	Creates the thumbnails for the Crop or Image with the given id, or for all
+	of an Image's crops at once
+	"""
+	from cropduster.models import Crop, Image
+	model, method = {
+		CROP: (Crop, "create_thumbnails"),
+		IMAGE: (Image, "create_thumbnails"),
+		CROPS: (Image, "create_crop_thumbnails"),
+	}[task]
+	getattr(model.objects.get(pk=object_id), method)()
+
+def _run_pooled(task, object_id):
+	try:
+		run_task(task, object_id)
+	except Exception:
+		logging.exception("Thumbnail job failed: %s %s" % (task, object_id))
+		raise
+
+
+class ImmediateBackend(object):
+
+	def enqueue(self, task, object_id, image_id):
+		run_task(task, object_id)
+		return None
+
+	def status(self, job_id):
+		return DONE
+
+	def pending(self, image_id):
+		return 0
+
+
+def _init_process():
+	# Don't share the parent's database connection; the child opens its own
+	connection.connection = None
+
+
+class ThreadBackend(object):
+	"""
+	Runs jobs in a pool belonging to the current process. The status of the
+	most recent jobs is kept in memory, so it can only be polled from the
+	process that enqueued them.
+
+	Jobs can start before the transaction that enqueued them commits; with
+	TransactionMiddleware, use DatabaseBackend instead.
+	"""
+
+	pool_class = ThreadPool
+	pool_initializer = None
+	max_results = 1000
+
+	def __init__(self, workers=JOB_WORKERS):
+		self.workers = workers
+		self._pool = None
+		self._lock = threading.Lock()
+		# Guards _results, which request threads share
+		self._results_lock = threading.Lock()
+		self._results = {}
+
+	def get_pool(self):
+		self._lock.acquire()
+		try:
+			if self._pool is None:
+				self._pool = self.pool_class(self.workers, self.pool_initializer)
+			return self._pool
+		finally:
+			self._lock.release()
+
+	def enqueue(self, task, object_id, image_id):
+		job_id = uuid.uuid4().hex
+		result = self.get_pool().apply_async(_run_pooled, (task, object_id))
+
+		self._results_lock.acquire()
+		try:
+			if len(self._results) >= self.max_results:
+				for _job_id, (_image_id, _result) in self._results.items():
+					if _result.ready():
+						del self._results[_job_id]
+			self._results[job_id] = (image_id, result)
+		finally:
+			self._results_lock.release()
+		return job_id
+
+	def status(self, job_id):
+		self._results_lock.acquire()
+		try:
+			image_id, result = self._results[job_id]
+		except KeyError:
+			return None
+		finally:
+			self._results_lock.release()
+		if not result.ready():
+			return PENDING
+		return DONE if result.successful() else FAILED
+
+	def pending(self, image_id):
+		self._results_lock.acquire()
+		try:
+			results = self._results.values()
+		finally:
+			self._results_lock.release()
+		return len([result for _image_id, result in results
+			if _image_id == image_id and not result.ready()])
+
+
+class ProcessBackend(ThreadBackend):
+	pool_class = Pool
+	pool_initializer = staticmethod(_init_process)
+
+
+class DatabaseBackend(object):
+	"""
+	Queues jobs in the database. A job for a crop or image that is still
+	waiting to run is reused rather than queued twice.
+	"""
+
+	def enqueue(self, task, object_id, image_id):
+		from cropduster.models import Job
+		try:
+			return Job.objects.filter(task=task, object_id=object_id, status=PENDING)[0].pk
+		except IndexError:
+			return Job.objects.create(task=task, object_id=object_id, image_id=image_id).pk
+
+	def status(self, job_id):
+		from cropduster.models import Job
+		try:
+			return Job.objects.filter(pk=int(job_id)).values_list("status", flat=True)[0]
+		except (IndexError, TypeError, ValueError):
+			return None
+
+	def pending(self, image_id):
+		from cropduster.models import Job
+		return Job.objects.filter(image=image_id, status__in=(PENDING, RUNNING)).count()
+
+
+def run_next_job():
+	"""
+	Claims the oldest pending job in the database queue and runs it. Returns
+	the job, or None if there was nothing to run.
+	"""
+	from cropduster.models import Job
+	while True:
+		try:
+			job = Job.objects.filter(status=PENDING).order_by("id")[0]
+		except IndexError:
+			return None
+
+		# Another worker may have claimed it in the meantime
+		now = datetime.datetime.now()
+		if Job.objects.filter(pk=job.pk, status=PENDING).update(status=RUNNING, started=now):
+			break
+
+	try:
+		run_task(job.task, job.object_id)
+	except Exception:
+		job.status, job.error = FAILED, traceback.format_exc()
+	else:
+		job.status = DONE
+	job.finished = datetime.datetime.now()
+	Job.objects.filter(pk=job.pk).update(status=job.status, error=job.error, finished=job.finished)
+	return job
+
+
+_backend = None
+
+def get_backend():
+	global _backend
+	if _backend is None:
+		module_name, class_name = JOB_BACKEND.rsplit(".", 1)
+		_backend = getattr(import_module(module_name), class_name)()
+	return _backend
+
+def enqueue(task, object_id, image_id):
+	""" Enqueues a task with the configured backend, returning the job id """
+	return get_backend().enqueue(task, object_id, image_id)
+
+def status(job_id):
+	""" Returns the status of a job, or None if there is no such job """
+	return get_backend().status(job_id)
+
+def pending(image_id):
+	""" Returns the number of unfinished jobs for an image """
+	return get_backend().pending(image_id)
@@ -6,15 +6,25 @@
 
 import sys
 import os
+import shlex
+import tarfile
 import tempfile
+import subprocess
+from multiprocessing.pool import ThreadPool
 from optparse import make_option
 
 from django.core.management.base import BaseCommand, CommandError
 
-from cropduster.models import Image as CropDusterImage,CropDusterField as CDF
-from cropduster.utils import create_cropped_image, rescale
+from cropduster.backup import MANIFEST_NAME, ORIGINAL, DERIVED, Entry, \
+                              format_entry, hash_file, read_manifest
+from cropduster.models import Image as CropDusterImage,CropDusterField as CDF, \
+                             Thumbnail
+from cropduster.utils import CHUNK_SIZE, chunked
 import apputils
-import Image
+
+# Number of files stat'ed and hashed at a time, which bounds how far hashing
+# runs ahead of the archive.
+HASH_BATCH_SIZE = 256
 
 class Command(BaseCommand):
     args = "app1 [app2...]"
@@ -36,7 +46,33 @@ class Command(BaseCommand):
         make_option('--backup_file',
                     dest="backup_file",
                     default="cropduster.bak.tar",
-                    help = "TarFile location to store backup")
+                    help = "TarFile location to store backup"),
+
+        make_option('--compression',
+                    dest="compression",
+                    type="choice",
+                    choices=("", "gz", "bz2"),
+                    default="",
+                    help = "Compresses the backup with gz or bz2.  Default is "\
+                           "no compression"),
+
+        make_option('--compress_program',
+                    dest="compress_program",
+                    default=None,
+                    help = "Pipes the backup through a compression program, "\
+                           "e.g. 'zstd -T0', instead"),
+
+        make_option('--since',
+                    dest="since",
+                    default=None,
+                    help = "Manifest of a previous backup.  Only files that "\
+                           "changed since then are archived"),
+
+        make_option('--hash_threads',
+                    dest="hash_threads",
+                    type="int",
+                    default=4,
+                    help = "Number of threads hashing files.  Default is 4")
     )
     
     def get_queryset(self, model, query_str):
@@ -55,36 +91,18 @@ class Command(BaseCommand):
         query_str = 'model.objects.' + query_str.lstrip('.')
         return eval(query_str, dict(model=model))
 
-    def get_derived_paths(self, cd_image):
-        """
-        Gets the derived image paths.
-
-        @param cd_image: Cropduster image to use
-        @type  cd_image: CropDusterImage
-
-        @return: Set of paths
-        @rtype:  Sizes
+    def get_cd_images(self, apps, query_set):
         """
-        sizes = []
-        for size in cd_image.size_set.size_set.all():
-            path = cd_image.thumbnail_path(size)
-            if os.path.exists(path):
-                yield path
-
-    def find_image_files(self, apps, query_set, only_originals):
-        """
-        Finds all images specified in apps and builds a list of paths that
-        need to be stored.
+        Returns all cropduster images for the given apps and query sets.
 
         @param apps: Set of app paths to look for images in.
         @type  apps: ["app[:model[.field]], ...]
         
         @param query_set: Query set of models to backup.
         @type  query_set: str 
-        
-        @param only_originals: Whether or not to only backup originals.
-        @type  only_originals: bool
 
+        @return: Generator yielding cropduster images.
+        @rtype: < CropDusterImage, ... >
         """
         # Figures out the models and cropduster fields on them
         for model, field_names in apputils.resolve_apps(apps):
@@ -100,24 +118,105 @@ class Command(BaseCommand):
                     if not (cd_image and isinstance(cd_image, CropDusterImage)):
                         continue
 
-                    # Make sure the image actually exists.
-                    file_name = cd_image.image.path
-                    if not os.path.exists(file_name):
-                        sys.stderr.write('missing: %s\n' % file_name)
-                        continue
+                    yield cd_image
 
-                    yield file_name
-                    if only_originals:
-                        continue
-                    
-                    # Get all derived images as well
-                    for path in self.get_derived_paths(cd_image):
-                        yield path
+    def find_image_files(self, apps, query_set, only_originals):
+        """
+        Finds all images specified in apps and builds a list of paths that
+        need to be stored.  Thumbnails are taken from the thumbnail inventory,
+        a chunk of images at a time, rather than looked for on disk; run 
+        regenerate_thumbs --assume_current first to add thumbnails written 
+        before the inventory was kept.
+
+        @param apps: Set of app paths to look for images in.
+        @type  apps: ["app[:model[.field]], ...]
+        
+        @param query_set: Query set of models to backup.
+        @type  query_set: str 
+        
+        @param only_originals: Whether or not to only backup originals.
+        @type  only_originals: bool
+
+        @return: Generator yielding the kind of each file and its path
+        @rtype: < (ORIGINAL or DERIVED, path), ... >
+        """
+        for cd_images in chunked(self.get_cd_images(apps, query_set), CHUNK_SIZE):
+
+            derived = {}
+            if not only_originals:
+                thumbnails = Thumbnail.objects.filter(image__in=[cd_image.id for cd_image in cd_images])
+                for image_id, path in thumbnails.exclude(path="").values_list('image', 'path'):
+                    derived.setdefault(image_id, []).append(path)
+
+            for cd_image in cd_images:
+                # Missing files are reported when they're stat'ed
+                yield ORIGINAL, cd_image.image.path
+                for path in derived.get(cd_image.id, ()):
+                    yield DERIVED, path
+
+    def check_file(self, kind, path, previous):
+        """
+        Stats a file and, unless its size and modification time match the 
+        previous backup's, hashes it.
+
+        @param kind: ORIGINAL or DERIVED
+        @type  kind: str
+
+        @param path: Path of the file
+        @type  path: str
+
+        @param previous: Previous backup's manifest entries, by path
+        @type  previous: {path: Entry}
+
+        @return: The file's manifest entry and whether it changed since the 
+                 previous backup, or None if the file doesn't exist.
+        @rtype: (Entry, bool) or None
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        old = previous.get(path)
+        if old and old.size == stat.st_size and old.mtime == int(stat.st_mtime):
+            return old._replace(kind=kind), False
+
+        # Touched but not changed files don't need archiving again
+        sha1 = hash_file(path)
+        entry = Entry(kind, stat.st_size, int(stat.st_mtime), sha1, path)
+        return entry, not (old and old.sha1 == sha1)
+
+    def open_archive(self, path, compression, compress_program):
+        """
+        Opens a tar stream to write the backup to.
+
+        @return: The tar file, the file object it writes to, and the 
+                 compression program's process if one is being used.
+        @rtype: (TarFile, file, Popen or None)
+        """
+        out = open(path, 'wb')
+        if not compress_program:
+            return tarfile.open(fileobj=out, mode='w|' + compression), out, None
+
+        proc = subprocess.Popen(shlex.split(compress_program),
+                                stdin=subprocess.PIPE, stdout=out)
+        out.close()
+        return tarfile.open(fileobj=proc.stdin, mode='w|'), proc.stdin, proc
+
+    def close_archive(self, tar, out, proc):
+        """
+        Finishes the tar stream, and waits for the compression program.
+        """
+        tar.close()
+        out.close()
+        if proc is not None and proc.wait() > 0:
+            raise CommandError("Failed when compressing files!  Exit code: %i" % proc.returncode)
 
     #@PrettyError("Failed to build thumbs: %(error)s")
     def handle(self, *apps, **options):
         """
-        Grabs all images for a given app and stores them in a tar file.
+        Grabs all images for a given app and streams them into a tar file,
+        followed by a manifest of everything that was found.
         """
         abs_path = os.path.abspath( options['backup_file'] )
         if os.path.exists(abs_path):
@@ -127,25 +226,56 @@ class Command(BaseCommand):
             if not ret.lower() == 'y':
                 raise SystemExit('Quitting...')
 
-        file_list_path = abs_path + '.files'
-        
-        print "Finding image files..."
-        # find all images
-        with file(file_list_path, 'w') as file_list:
-            for i, path in enumerate(self.find_image_files(apps,
-                                               options['query_set'],
-                                               options['only_origs'])):
-                file_list.write( (path+'\n').encode('utf8') )
-            
-            print "Found %i images to archive" % (locals().get('i', -1) + 1)
-
-        # attempt to tar 
-        print "Tarring...."
-        ret_code = os.system('tar cvf %s.tmp -T %s' % (abs_path, file_list_path)) >> 8
-        if ret_code > 0:
-            raise CommandError("Failed when tarring files!  Exit code: %i" % ret_code)
-            
+        if options['compression'] and options['compress_program']:
+            raise CommandError("Use either --compression or --compress_program, not both")
+
+        previous = {}
+        if options['since']:
+            with open(options['since']) as since:
+                previous = read_manifest(since)
+
+        manifest_path = abs_path + '.manifest'
+        manifest = tempfile.NamedTemporaryFile(dir=os.path.dirname(abs_path), delete=False)
+        tar, out, proc = self.open_archive(abs_path + '.tmp', options['compression'],
+                                           options['compress_program'])
+        pool = ThreadPool(options['hash_threads'])
+        found = archived = 0
+
+        print "Archiving image files..."
+        try:
+            files = self.find_image_files(apps, options['query_set'], options['only_origs'])
+
+            # Hash a batch of files in parallel, then archive the changed ones
+            for batch in chunked(files, HASH_BATCH_SIZE):
+                results = pool.map(lambda item: self.check_file(item[0], item[1], previous), batch)
+                for (kind, path), result in zip(batch, results):
+                    if result is None:
+                        sys.stderr.write('missing: %s\n' % path)
+                        continue
+
+                    entry, changed = result
+                    manifest.write(format_entry(entry).encode('utf8'))
+                    found += 1
+                    if changed:
+                        tar.add(path, arcname=path.lstrip('/'), recursive=False)
+                        archived += 1
+
+            manifest.close()
+            tar.add(manifest.name, arcname=MANIFEST_NAME)
+            self.close_archive(tar, out, proc)
+        except:
+            manifest.close()
+            os.remove(manifest.name)
+            out.close()
+            if proc is not None:
+                proc.wait()
+            os.remove(abs_path + '.tmp')
+            raise
+        finally:
+            pool.close()
+
         # Success!
-        os.remove(file_list_path)
+        os.rename(manifest.name, manifest_path)
         os.rename(abs_path+'.tmp', abs_path)
-        print "Successfully tarred images to %s" % abs_path
+        print "Archived %i of %i image files to %s" % (archived, found, abs_path)
+        print "Manifest written to %s" % manifest_path
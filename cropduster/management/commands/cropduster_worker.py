@@ -0,0 +1,62 @@
+import sys
+import time
+from optparse import make_option
+
+from django.db import reset_queries
+from django.core.management.base import BaseCommand
+
+from cropduster import jobs
+from cropduster.models import Job
+
+class Command(BaseCommand):
+    help = "Runs the thumbnail jobs queued by cropduster.jobs.DatabaseBackend."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--once',
+                    action  = "store_true",
+                    dest    = "once",
+                    default = False,
+                    help    = "Exits once the queue is empty rather than waiting"\
+                              " for more jobs."),
+
+        make_option('--sleep',
+                    dest    = "sleep",
+                    type    = "float",
+                    default = 1.0,
+                    help    = "Seconds to wait before checking an empty queue "\
+                              "again.  Default is 1"),
+
+        make_option('--requeue',
+                    action  = "store_true",
+                    dest    = "requeue",
+                    default = False,
+                    help    = "Puts jobs still marked as running back in the "\
+                              "queue before starting.  Only use this when no "\
+                              "other worker is running."),
+    )
+
+    def handle(self, *args, **options):
+        """
+        Runs queued jobs, oldest first, until the queue is empty (with --once)
+        or forever.
+        """
+        verbosity = int(options.get('verbosity', 1))
+
+        if options['requeue']:
+            Job.objects.filter(status=jobs.RUNNING).update(status=jobs.PENDING, started=None)
+
+        while True:
+            # Don't let DEBUG query logging grow without bound
+            reset_queries()
+
+            job = jobs.run_next_job()
+            if job is None:
+                if options['once']:
+                    return
+                time.sleep(options['sleep'])
+                continue
+
+            if job.status == jobs.FAILED:
+                sys.stderr.write("Job %i (%s %i) failed:\n%s\n" % (job.pk, job.task, job.object_id, job.error))
+            elif verbosity > 1:
+                print "Job %i (%s %i) done" % (job.pk, job.task, job.object_id)
@@ -6,17 +6,25 @@
 
 import sys
 import os
+import time
+import signal
+import datetime
 import logging
 import inspect
 import traceback
 from collections import namedtuple
+from multiprocessing import Pool
 from optparse import make_option
 
+from django.db import connection
 from django.db.models.base import ModelBase
 from django.core.management.base import BaseCommand, CommandError
 
-from cropduster.models import Image as CropDusterImage,CropDusterField as CDF
-from cropduster.utils import create_cropped_image, rescale
+from cropduster.models import Image as CropDusterImage,CropDusterField as CDF, \
+                             Crop, Thumbnail
+from cropduster.files import locked, makedirs, save_thumbnail
+from cropduster.utils import CHUNK_SIZE, chunked, create_cropped_image, file_fingerprint, \
+                            group_by_aspect_ratio, open_image, rescale_chain
 import apputils
 import Image
 
@@ -51,7 +59,37 @@ class PrettyError(object):
 
         return _f
 
-Size = namedtuple('Size', ('name', 'path', 'crop', 'width', 'height'))
+Size = namedtuple('Size', ('name', 'path', 'crop', 'width', 'height',
+                           'id', 'fingerprint', 'crop_box', 'aspect_ratio',
+                           'encoding_profile', 'max_bytes'))
+
+def init_worker():
+    """
+    Sets up a pool worker.  Workers leave the parent's database connection
+    alone, and leave handling Ctrl-C to the parent.
+    """
+    connection.connection = None
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def resize_task(task):
+    """
+    Pool worker entry point: opens an original and writes its thumbnails.
+    Errors are returned rather than raised, so a bad image doesn't take the
+    worker down with it.
+
+    @param task: Image id, path and fingerprint of the original, and the 
+                 sizes to create.
+    @type  task: (int, str, str, set([Size, ...]))
+
+    @return: The task, the thumbnails written and the error, if there was one.
+    @rtype: (task, {Size: (width, height, filesize, quality)}, str or None)
+    """
+    image_id, file_name, source, sizes = task
+    try:
+        written = Command().resize_image(file_name, sizes)
+    except Exception:
+        return task, {}, traceback.format_exc()
+    return task, written, None
 
 class Command(BaseCommand):
     args = "app_name[:model[.field]][, ...]"
@@ -64,7 +102,15 @@ class Command(BaseCommand):
                     dest    = "force",
                     default = False,
                     help    = "Resizes all images regardless of whether or not"\
-                              " they already exist."),
+                              " they are up to date."),
+
+        make_option('--assume_current',
+                    action  = "store_true",
+                    dest    = "assume_current",
+                    default = False,
+                    help    = "Records existing thumbnails that have no manifest"\
+                              " entry as up to date instead of resizing them. "\
+                              "Useful the first time the manifest is built."),
 
         make_option('--query_set',
                     dest    = "query_set",
@@ -99,13 +145,24 @@ class Command(BaseCommand):
                     type="int",
                     default=1,
                     help="Indicates how many procs to use for converting images.  "\
-                         "Default is 1")
+                         "Default is 1"),
+
+        make_option('--tasks_per_child',
+                    dest='tasks_per_child',
+                    type="int",
+                    default=100,
+                    help="Number of images a process converts before it is "\
+                         "replaced with a fresh one.  Default is 100"),
+
+        make_option('--task_timeout',
+                    dest='task_timeout',
+                    type="int",
+                    default=600,
+                    help="Seconds to wait for any image to finish before the "\
+                         "oldest one being converted is given up as lost, as "\
+                         "when its process dies.  Default is 600")
     )
     
-    IMG_TYPE_PARAMS = {
-        'JPEG': dict(quality=95)
-    }
-    
     def get_queryset(self, model, query_str):
         """
         Gets the query set from the provided model based on the user's filters.
@@ -122,58 +179,109 @@ class Command(BaseCommand):
         query_str = 'model.objects.' + query_str.lstrip('.')
         return eval(query_str, dict(model=model))
 
-    def resize_image(self, image, sizes, force):
+    def resize_image(self, file_name, sizes):
         """
-        Resizes an image to the provided set sizes.
+        Resizes an image to the provided set sizes, the same way saving its
+        crops and the image itself would: sizes with a crop are cut from the
+        original once per crop and rescaled from largest to smallest, and the
+        rest are rescaled from the whole original, once per aspect ratio.
 
-        @param image: Opened original image
-        @type  image: PIL.Image
+        @param file_name: Path of the original image
+        @type  file_name: str
         
         @param sizes: Set of sizes to create.
         @type  sizes: [Size1, ...]
-        
-        @param force: Whether or not to recreate a thumbnail if it already exists.
-        @type  force: bool
 
-        @return: 
-        @rtype: 
+        @return: The dimensions, size in bytes and quality of each thumbnail
+                 written.
+        @rtype: {Size: (width, height, filesize, quality)}
+        """
+        # The same locks as the models take, so a thumbnail that a request or
+        # job worker creates in the meantime isn't created again here
+        requested = time.time()
+        with locked(size.path for size in sizes):
+            sizes = [size for size in sizes if not self.written_since(size.path, requested)]
+            if not sizes:
+                return {}
+            return self.resize_locked(file_name, sizes)
+
+    def written_since(self, path, since):
+        """
+        Whether the file at path was written after the given time.
+        """
+        try:
+            return os.stat(path).st_mtime >= since
+        except OSError:
+            return False
+
+    def resize_locked(self, file_name, sizes):
+        """
+        Does the work of resize_image, once the sizes' locks are held.
         """
-        img_params = (self.IMG_TYPE_PARAMS.get(image.format) or {}).copy()
+        written = {}
+        cropped = {}
+        uncropped = []
         for size in sizes:
-            
-            logging.debug('Converting image to size `%s` (%s x %s)' % (size.name,
-                                                                       size.width,
-                                                                       size.height))
-            # Do we need to recreate the file?
-            if not force and os.path.isfile(size.path) and os.stat(size.path).st_size > 0:
-                logging.debug(' - Image `%s` exists, skipping...' % size.name)
-                continue
-
-            folder, _basename = os.path.split(size.path)
-            if not os.path.isdir(folder):
-                logging.debug(' - Directory %s does not exist.  Creating...' % folder)
-                os.makedirs(folder)
+            if size.crop_box:
+                cropped.setdefault(size.crop_box, []).append(size)
+            else:
+                uncropped.append(size)
+
+        # All of an image's thumbnails go in the same folder
+        makedirs(os.path.dirname(sizes[0].path))
+
+        # Decode at a reduced scale wherever the largest size allows it
+        for crop_box, group in cropped.items():
+            image = create_cropped_image(file_name, *crop_box,
+                                         min_width=max([s.width or 0 for s in group]),
+                                         min_height=max([s.height or 0 for s in group]))
+            for size, thumbnail in rescale_chain(image, group, crop=False):
+                written[size] = self.save_thumbnail(thumbnail, size, image.format)
+
+        if uncropped:
+            image = open_image(file_name,
+                               min_width=max([s.width or 0 for s in uncropped]),
+                               min_height=max([s.height or 0 for s in uncropped]))
+            for group in group_by_aspect_ratio(uncropped):
+                for size, thumbnail in rescale_chain(image, group, crop=True):
+                    written[size] = self.save_thumbnail(thumbnail, size, image.format)
+        return written
+
+    def save_thumbnail(self, thumbnail, size, format):
+        """
+        Saves a thumbnail, via a temporary file so a half written thumbnail is
+        never served (see cropduster.files.save_thumbnail).
 
-            try:
-                # In place scaling, so we need to use a copy of the image.
-                thumbnail = rescale(image.copy(),
-                                    size.width,
-                                    size.height,
-                                    crop=size.crop)
+        @param thumbnail: Rescaled image
+        @type  thumbnail: PIL.Image
 
-                tmp_path = size.path + '.tmp'
+        @param size: Size of the thumbnail
+        @type  size: Size
 
-                thumbnail.save(tmp_path, image.format, **img_params)
+        @param format: Format of the original, which the thumbnail is saved
+                       in unless the size's encoding profile says otherwise
+        @type  format: str
 
-            # No idea what this can throw, so catch them all
-            except Exception, e:
-                logging.exception('Error saving thumbnail to %s' % tmp_path)
-                raise SystemExit('Exiting...')
-                
-            else:
-                os.rename(tmp_path, size.path)
+        @return: The thumbnail's dimensions, size in bytes and quality (None
+                 for formats without a quality setting).
+        @rtype: (int, int, int, int)
+        """
+        logging.debug('Converting image to size `%s` (%s x %s)' % (size.name,
+                                                                   size.width,
+                                                                   size.height))
+        try:
+            filesize, quality = save_thumbnail(thumbnail, format, size.path, size,
+                                               size.encoding_profile)
+
+        # No idea what this can throw, so catch them all
+        except Exception, e:
+            logging.exception('Error saving thumbnail to %s' % size.path)
+            raise
+            
+        else:
+            return thumbnail.size + (filesize, quality)
             
-    def get_sizes(self, cd_image, stretch):
+    def get_sizes(self, cd_image, stretch, crops):
         """
         Extracts sizes for an image.
 
@@ -184,24 +292,88 @@ class Command(BaseCommand):
                         would stretch the original image.
         @type  stretch: bool
 
+        @param crops: The image's crops, by aspect ratio
+        @type  crops: {aspect_ratio: Crop}
+
         @return: Set of sizes to use
         @rtype:  set([Size, ...])
         """
         sizes = []
-        orig_width, orig_height = cd_image.image.width, cd_image.image.height
+        orig_width, orig_height = cd_image.width, cd_image.height
         for size in cd_image.size_set.size_set.all():
 
             # Filter out thumbnail sizes which are larger than the original
             if stretch or (orig_width >= size.width and 
                            orig_height >= size.height):
 
+                crop = None if size.auto_size else crops.get(size.aspect_ratio)
+                if crop and not (crop.crop_w and crop.crop_h):
+                    crop = None
                 sizes.append( Size(size.slug,
                                    cd_image.thumbnail_path(size),
                                    size.auto_size,
                                    size.width,
-                                   size.height) )
+                                   size.height,
+                                   size.id,
+                                   size.fingerprint,
+                                   crop and (crop.crop_x, crop.crop_y, crop.crop_w, crop.crop_h),
+                                   size.aspect_ratio,
+                                   size.get_encoding_profile(),
+                                   size.max_bytes) )
         return set(sizes)
 
+    def is_stale(self, entry, source, size):
+        """
+        Checks a thumbnail's manifest entry against what it would be created
+        from now.
+
+        @param entry: Manifest entry for the thumbnail, if there is one.
+        @type  entry: Thumbnail or None
+
+        @param source: Fingerprint of the original.
+        @type  source: str
+
+        @param size: Size of the thumbnail.
+        @type  size: Size
+
+        @return: Whether the thumbnail needs to be recreated.
+        @rtype: bool
+        """
+        return (entry is None or
+                entry.source_fingerprint != source or
+                entry.crop_box != size.crop_box or
+                entry.size_fingerprint != size.fingerprint)
+
+    def file_size(self, path):
+        """
+        Returns the size of a thumbnail missing from the manifest, or None if
+        it doesn't exist.
+        """
+        try:
+            return os.stat(path).st_size
+        except OSError:
+            return None
+
+    def record(self, image_id, source, size, info=None):
+        """
+        Records a thumbnail as up to date in the manifest.
+
+        @param info: Dimensions, size in bytes and quality of the thumbnail,
+                     if known.
+        @type  info: (int, int, int, int) or None
+        """
+        width, height, filesize, quality = info or (None, None, None, None)
+        crop_x, crop_y, crop_w, crop_h = size.crop_box or (None, None, None, None)
+        Thumbnail.objects.record(image_id, size.id,
+                                 path=size.path,
+                                 width=width, height=height,
+                                 filesize=filesize,
+                                 generated=datetime.datetime.now(),
+                                 source_fingerprint=source,
+                                 crop_x=crop_x, crop_y=crop_y,
+                                 crop_w=crop_w, crop_h=crop_h,
+                                 size_fingerprint=size.fingerprint,
+                                 quality=quality)
 
     def setup_logging(self, options):
         """
@@ -218,22 +390,18 @@ class Command(BaseCommand):
             sh.formatter = formatter
             logging.root.addHandler( sh )
     
-    def get_images(self, apps, query_set, stretch):
+    def get_cd_images(self, apps, query_set):
         """
-        Returns all original images and sizes for the given apps and query sets.
+        Returns all cropduster images for the given apps and query sets.
         
         @param apps: Set of django apps to resize.
         @type  apps: ["app:[model[.field]]", ..]
         
         @param query_set: query_set to retrieve objects with.
         @type  query_set: str.
-        
-        @param stretch: Whether or not to include sizes with dimensions larger 
-                        than the original image size.
-        @type  stretch: bool
 
-        @return: Generator yielding the raw Image and its sizes
-        @rtype: < (PIL.Image, [set([Size1, ...])), ... >
+        @return: Generator yielding cropduster images.
+        @rtype: < CropDusterImage, ... >
         """
         # Figures out the models and cropduster fields on them
         for model, field_names in to_CE(apputils.resolve_apps, apps):
@@ -252,98 +420,182 @@ class Command(BaseCommand):
                     if not (cd_image and isinstance(cd_image, CropDusterImage)):
                         continue
 
-                    file_name = cd_image.image.path
-                    logging.info("Processing image %s" % file_name)
-                    try:
-                        image = Image.open(file_name)
-                    except IOError:
-                        logging.warning('Could not open image %s' % file_name)
-                        continue
-
-                    sizes = self.get_sizes(cd_image, stretch)
-                    #self.resize_image(image, sizes, options['force'])
-                    yield image, sizes
+                    yield cd_image
 
-    def wait_all(self):
-        """
-        Wait for all child procs to finish.
+    def get_images(self, apps, query_set, stretch, force, assume_current):
         """
-        while True:
-            try:
-                os.wait()
-            except OSError,e:
-                # Excellent, no longer waiting on a child proc
-                if e.errno == 10:
-                    return
-                raise
+        Returns the original images with thumbnails that are out of date,
+        according to the manifest, and those thumbnails' sizes.
+        
+        @param apps: Set of django apps to resize.
+        @type  apps: ["app:[model[.field]]", ..]
+        
+        @param query_set: query_set to retrieve objects with.
+        @type  query_set: str.
+        
+        @param stretch: Whether or not to include sizes with dimensions larger 
+                        than the original image size.
+        @type  stretch: bool
 
-    def wait_one(self, proc_list):
-        """
-        Waits for any process to finish.  If any child terminated
-        abnormally, raise an OSError.
+        @param force: Whether to include all sizes, up to date or not.
+        @type  force: bool
 
-        @param proc_list: Set of child procs.
-        @type  proc_list: set(int, ...)
+        @param assume_current: Whether to record existing thumbnails with no
+                               manifest entry as up to date.
+        @type  assume_current: bool
 
-        @return: 
-        @rtype: 
+        @return: Generator yielding the id, path and fingerprint of each 
+                 original and the sizes to create.  Images are not opened 
+                 here; that's left to the workers.
+        @rtype: < (int, str, str, set([Size1, ...])), ... >
         """
-        pid, code = os.wait()
-        proc_list.remove(pid)
-        # If an error
-        if code > 0:
-            self.wait_all(proc_list)
-            raise OSError('Process %i died with %i' % (pid, code))
-
-    def resize_parallel(self, images, force, total_procs):
+        for cd_images in chunked(self.get_cd_images(apps, query_set), CHUNK_SIZE):
+
+            # Fetch the manifest entries and crops for the whole chunk at once
+            image_ids = [cd_image.id for cd_image in cd_images]
+            manifest = dict(((entry.image_id, entry.size_id), entry) for entry in
+                            Thumbnail.objects.filter(image__in=image_ids))
+            crops = {}
+            for crop in Crop.objects.filter(image__in=image_ids).select_related('size'):
+                crops.setdefault(crop.image_id, {})[crop.size.aspect_ratio] = crop
+
+            for cd_image in cd_images:
+                file_name = cd_image.image.path
+                try:
+                    source = file_fingerprint(file_name)
+                except OSError:
+                    logging.warning('Could not find image %s' % file_name)
+                    continue
+
+                # get_sizes compares the sizes with the original's dimensions
+                try:
+                    cd_image.ensure_dimensions()
+                except (IOError, OSError), e:
+                    logging.warning('Could not read image %s: %s' % (file_name, e))
+                    continue
+
+                sizes = set()
+                for size in self.get_sizes(cd_image, stretch, crops.get(cd_image.id, {})):
+                    entry = manifest.get((cd_image.id, size.id))
+                    filesize = assume_current and entry is None and self.file_size(size.path)
+                    if filesize:
+                        self.record(cd_image.id, source, size, (None, None, filesize, None))
+                    elif force or self.is_stale(entry, source, size):
+                        sizes.add(size)
+                    else:
+                        logging.debug(' - Image `%s` is up to date, skipping...' % size.path)
+                        # Entries from before the manifest recorded paths
+                        if not entry.path:
+                            Thumbnail.objects.filter(pk=entry.pk).update(path=size.path)
+
+                if sizes:
+                    yield cd_image.id, file_name, source, sizes
+
+    def resize_parallel(self, images, total_procs, tasks_per_child, task_timeout=600):
         """
-        Resizes images in parallel.  
-        
-        Why not use multiprocessing?  First reason is that we don't care 
-        about return values, which makes the synchronization for Pool objects 
-        more than we need.
-
-        Secondly, Process() has issues with KeyboardInterrupt exceptions,
-        which is a bummer when testing. Further, we never know which Process 
-        finishes first without using os.wait, which at that point we have 
-        what we have below.  The other option would be to loop through each
-        process, calling its join() method with a timeout, which  basically
-        turns the parent process into a spin lock.
-
-        Thirdly, we want to throw away our process when we are done with each
-        image.  Forking is cheap due to copy-on-write, and this keeps the 
-        memory consumption down.
-
-        @param images: Iterator yield images with their size set.
-        @type  images: ((image, sizes), ...]
-        
-        @param force: Whether or not resize images which already exist.
-        @type  force: bool
+        Resizes images in a pool of worker processes.
+
+        The workers live for the whole run, and are only given the id and path
+        of each original, so nothing is decoded in this process.  Each worker 
+        is replaced after tasks_per_child images to keep its memory bounded.
+        Results and failures are logged, and successes recorded in the 
+        manifest, as they come back; only as many images are handed to the 
+        pool at a time as will keep the workers busy.  An image that can't be
+        handed over, or whose worker dies, is counted as failed; the latter is
+        only noticed when no image has finished for task_timeout seconds.
+
+        @param images: Iterator yielding image ids, paths and fingerprints with 
+                       their sizes.
+        @type  images: ((id, path, fingerprint, sizes), ...]
         
         @param total_procs: Total number of processes to use.
         @type  total_procs: positive int
+
+        @param tasks_per_child: Images a worker processes before it is replaced.
+        @type  tasks_per_child: positive int
+
+        @param task_timeout: Seconds to wait for an image to finish before
+                             giving up on the oldest one.
+        @type  task_timeout: positive int
+
+        @return: Paths of the images that failed.
+        @rtype: [str, ...]
         """
-        proc_list = set()
-        try:
-            for image, size in images:
-                if len(proc_list) == total_procs:
-                    self.wait_one(proc_list)
-           
-                pid = os.fork()
-                if pid:
-                    proc_list.add(pid)
-                    continue
+        failures = []
 
-                # The child carries on
+        def handle_result(result):
+            (image_id, file_name, source, sizes), written, error = result
+            if error is None:
+                logging.info("Processed image %s" % file_name)
                 try:
-                    self.resize_image(image, size, force)
-                except:
-                    # Any error, doesn't matter what, must get caught.
-                    os._exit(1)
-                os._exit(0)
+                    # Sizes missing from written were created elsewhere
+                    # while the worker waited for them
+                    for size, info in written.items():
+                        self.record(image_id, source, size, info)
+                except Exception:
+                    logging.exception("Could not record thumbnails of %s" % file_name)
+            else:
+                logging.error("Failed to process image %i (%s):\n%s" % (image_id, file_name, error))
+                failures.append(file_name)
+
+        # No pool to speak of, do it here; handy for debugging.
+        if total_procs == 1:
+            for task in images:
+                handle_result(resize_task(task))
+            return failures
+
+        # Images handed to the pool and not yet back, oldest first
+        in_flight = []
+        lost = []
+
+        def wait(max_in_flight):
+            """
+            Handles images as they finish until no more than max_in_flight
+            are left in the pool.
+            """
+            waited = 0
+            while len(in_flight) > max_in_flight:
+                done = [(task, result) for task, result in in_flight if result.ready()]
+                if not done and waited < task_timeout:
+                    in_flight[0][1].wait(1)
+                    waited += 1
+                    continue
+                waited = 0
+
+                if not done:
+                    task = in_flight.pop(0)[0]
+                    logging.error("Gave up on image %i (%s) after %i seconds" % (task[0], task[1], task_timeout))
+                    failures.append(task[1])
+                    lost.append(task)
+                for task, result in done:
+                    in_flight.remove((task, result))
+                    try:
+                        handle_result(result.get())
+                    except Exception:
+                        # resize_task doesn't raise, so the task couldn't
+                        # be sent to a worker or its result back
+                        logging.exception("Failed to process image %i (%s)" % (task[0], task[1]))
+                        failures.append(task[1])
+
+        pool = Pool(total_procs, init_worker, maxtasksperchild=tasks_per_child)
+        try:
+            for task in images:
+                wait(total_procs * 2 - 1)
+                in_flight.append((task, pool.apply_async(resize_task, (task,))))
+            wait(0)
+        except:
+            pool.terminate()
+            raise
+        else:
+            # A lost image is never finished, and close() would wait for it
+            if lost:
+                pool.terminate()
+            else:
+                pool.close()
         finally:
-            # wait for the kids to finish, no zombies for us.
-            self.wait_all()
+            pool.join()
+
+        return failures
 
     @PrettyError("Failed to regenerate thumbs: %(error)s")
     def handle(self, *apps, **options):
@@ -354,9 +606,14 @@ class Command(BaseCommand):
         
         self.setup_logging(options)
 
-        # Get all images
-        images = self.get_images(apps, options['query_set'], options['stretch'])
+        # Get all images with out of date thumbnails
+        images = self.get_images(apps, options['query_set'], options['stretch'],
+                                 options['force'], options['assume_current'])
 
         # Go to town on the images.
-        self.resize_parallel(images, options['force'], options['procs'])
+        failures = self.resize_parallel(images, options['procs'],
+                                        options['tasks_per_child'],
+                                        options['task_timeout'])
+        if failures:
+            raise CommandError("%i images failed, see the log for details" % len(failures))
 
@@ -0,0 +1,270 @@
+import sys
+import os
+import errno
+import shlex
+import hashlib
+import tarfile
+import threading
+import subprocess
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+
+from cropduster.backup import MANIFEST_NAME, ORIGINAL, read_manifest
+
+class Command(BaseCommand):
+    args = "[app1 app2...]"
+    help = "Restores images from an archive written by backup_images, "\
+           "checking every file against the backup's manifest.  Apps given "\
+           "have their thumbnails regenerated afterwards with --regenerate."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--backup_file',
+                    dest="backup_file",
+                    default="cropduster.bak.tar",
+                    help = "TarFile to restore from"),
+
+        make_option('--manifest',
+                    dest="manifest",
+                    default=None,
+                    help = "Manifest to check files against.  Defaults to "\
+                           "<backup_file>.manifest if it exists, otherwise "\
+                           "the manifest at the end of the archive"),
+
+        make_option('--decompress_program',
+                    dest="decompress_program",
+                    default=None,
+                    help = "Program to pipe the archive through first, e.g. "\
+                           "'zstd -d'.  gz and bz2 archives are detected "\
+                           "without one"),
+
+        make_option('--root',
+                    dest="root",
+                    default="/",
+                    help = "Directory to restore into.  Default is /, which "\
+                           "puts files back where they were backed up from"),
+
+        make_option('--workers',
+                    dest="workers",
+                    type="int",
+                    default=4,
+                    help = "Number of threads writing files.  Default is 4"),
+
+        make_option('--only_originals',
+                    action="store_true",
+                    dest='only_origs',
+                    default=False,
+                    help="Restores only original images, leaving thumbnails "\
+                         "to be regenerated"),
+
+        make_option('--regenerate',
+                    action="store_true",
+                    dest='regenerate',
+                    default=False,
+                    help="Runs regenerate_thumbs for the given apps once the "\
+                         "files are restored"),
+    )
+
+    def open_archive(self, path, decompress_program):
+        """
+        Opens the archive as a tar stream.
+
+        @return: The tar file, and the decompression program's process if one
+                 is being used.
+        @rtype: (TarFile, Popen or None)
+        """
+        if not decompress_program:
+            return tarfile.open(path, 'r|*'), None
+
+        proc = subprocess.Popen(shlex.split(decompress_program),
+                                stdin=open(path, 'rb'), stdout=subprocess.PIPE)
+        return tarfile.open(fileobj=proc.stdout, mode='r|'), proc
+
+    def target_path(self, root, name):
+        """
+        Works out where an archive member is restored to, refusing members
+        that would end up outside of root.
+
+        @return: Path to restore the member to, and the path it was backed up
+                 from (its key in the manifest).
+        @rtype: (str, str)
+        """
+        name = os.path.normpath(name)
+        if os.path.isabs(name) or name.startswith(os.pardir):
+            raise CommandError("Refusing to restore %s outside of %s" % (name, root))
+        return os.path.join(root, name), u'/' + name.decode('utf8')
+
+    def in_place(self, path, entry):
+        """
+        Whether a file left out of the archive is already where it belongs,
+        with the size and modification time the manifest gives it.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        return stat.st_size == entry.size and int(stat.st_mtime) == entry.mtime
+
+    def write_file(self, key, path, data, mtime):
+        """
+        Writes a restored file next to where it belongs, keeping its
+        modification time.  Errors are returned rather than raised, so the
+        pool carries on and the result callback always runs, and the
+        temporary file is removed.
+
+        @return: The file's manifest key, path, temporary path and the sha1 of
+                 its contents, or the error in place of the sha1 if it
+                 couldn't be written.
+        @rtype: (str, str, str or None, str)
+        """
+        tmp_path = path + '.restore'
+        try:
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+            try:
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.utime(tmp_path, (mtime, mtime))
+                sha1 = hashlib.sha1(data).hexdigest()
+            except:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                raise
+        except Exception, e:
+            return key, path, None, str(e)
+        return key, path, tmp_path, sha1
+
+    def extract(self, tar, root, manifest, only_originals, workers):
+        """
+        Reads the archive, handing each file to a pool of threads that write
+        them out.  Only as many files as will keep the threads busy are held
+        in memory at a time.
+
+        @return: The files written, as (manifest key, path, temporary path,
+                 sha1), and the manifest at the end of the archive.
+        @rtype: ([(str, str, str, str), ...], {path: Entry} or None)
+        """
+        written = []
+        archived_manifest = None
+
+        # write_file doesn't raise, so done is called for every file
+        slots = threading.BoundedSemaphore(workers * 2)
+        def done(result):
+            written.append(result)
+            slots.release()
+
+        pool = ThreadPool(workers)
+        try:
+            for member in tar:
+                if member.name == MANIFEST_NAME:
+                    archived_manifest = read_manifest(tar.extractfile(member))
+                    continue
+                if not member.isfile():
+                    continue
+
+                path, key = self.target_path(root, member.name)
+
+                # Skip thumbnails now if the manifest says which they are
+                entry = manifest and manifest.get(key)
+                if only_originals and entry and entry.kind != ORIGINAL:
+                    continue
+
+                data = tar.extractfile(member).read()
+                slots.acquire()
+                pool.apply_async(self.write_file, (key, path, data, member.mtime),
+                                 callback=done)
+            pool.close()
+        except:
+            pool.terminate()
+            pool.join()
+            # Leave no half restored files behind
+            for key, path, tmp_path, sha1 in written:
+                if tmp_path:
+                    os.remove(tmp_path)
+            raise
+        pool.join()
+
+        return written, archived_manifest
+
+    def handle(self, *apps, **options):
+        """
+        Restores the archive, then checks each file against the manifest and
+        moves the good ones into place.
+        """
+        backup_file = os.path.abspath(options['backup_file'])
+        manifest_path = options['manifest'] or backup_file + '.manifest'
+        manifest = None
+        if options['manifest'] or os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = read_manifest(f)
+
+        print "Restoring files..."
+        tar, proc = self.open_archive(backup_file, options['decompress_program'])
+        try:
+            written, archived_manifest = self.extract(tar, options['root'], manifest,
+                                                      options['only_origs'],
+                                                      options['workers'])
+        finally:
+            tar.close()
+            if proc is not None:
+                proc.stdout.close()
+                proc.wait()
+
+        if proc is not None and proc.returncode > 0:
+            raise CommandError("Failed when decompressing files!  Exit code: %i" % proc.returncode)
+
+        manifest = manifest or archived_manifest
+        if manifest is None:
+            for key, path, tmp_path, sha1 in written:
+                if tmp_path:
+                    os.remove(tmp_path)
+            raise CommandError("No manifest found to check the files against")
+
+        restored = 0
+        failures = []
+        for key, path, tmp_path, sha1 in written:
+            entry = manifest.get(key)
+            if tmp_path is None:
+                failures.append((path, sha1))
+            elif entry is None or entry.sha1 != sha1:
+                failures.append((path, "does not match the manifest"))
+                os.remove(tmp_path)
+            elif options['only_origs'] and entry.kind != ORIGINAL:
+                os.remove(tmp_path)
+            else:
+                os.rename(tmp_path, path)
+                restored += 1
+
+        # Files the manifest lists that the archive doesn't have.  An
+        # incremental backup leaves out those that hadn't changed, which are
+        # fine if the backups before it put them back already.
+        extracted = set(key for key, path, tmp_path, sha1 in written)
+        for key, entry in sorted(manifest.items()):
+            if key in extracted or (options['only_origs'] and entry.kind != ORIGINAL):
+                continue
+            path = os.path.join(options['root'], key.lstrip(u'/').encode('utf8'))
+            if not self.in_place(path, entry):
+                failures.append((path, "missing from the archive"))
+
+        print "Restored %i image files" % restored
+        if failures:
+            for path, error in failures:
+                sys.stderr.write('failed: %s: %s\n' % (path, error))
+            raise CommandError("%i files could not be restored" % len(failures))
+
+        if options['regenerate'] and apps:
+            print "Regenerating thumbnails..."
+            # Restored originals keep their modification times, so the
+            # thumbnail manifest would otherwise call the missing thumbnails
+            # up to date.
+            call_command('regenerate_thumbs', *apps,
+                         force=options['only_origs'],
+                         procs=options['workers'])
@@ -0,0 +1,110 @@
+import sys
+import signal
+from multiprocessing import Pool, cpu_count
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cropduster.models import Image as CropDusterImage
+from cropduster.utils import CHUNK_SIZE, image_file_info
+
+def init_worker():
+    """
+    Leaves handling Ctrl-C to the parent.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def info_task(task):
+    """
+    Pool worker entry point: reads an image file's details.  Errors are
+    returned rather than raised.
+
+    @param task: Image id and path of the original.
+    @type  task: (int, str)
+
+    @return: The image id, and the file's details or the error.
+    @rtype: (int, tuple or None, str or None)
+    """
+    image_id, path = task
+    try:
+        with open(path, 'rb') as f:
+            return image_id, image_file_info(f), None
+    except Exception, e:
+        return image_id, None, '%s: %s' % (path, e)
+
+class Command(BaseCommand):
+    help = "Stores the dimensions, format, size and hash of cropduster "\
+           "images' files, for images uploaded before they were recorded."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--force',
+                    action  = "store_true",
+                    dest    = "force",
+                    default = False,
+                    help    = "Updates every image, not just those without "\
+                              "their details stored."),
+
+        make_option('--procs',
+                    dest    = "procs",
+                    type    = "int",
+                    default = cpu_count(),
+                    help    = "Number of processes reading files.  Default is "\
+                              "the number of CPUs"),
+    )
+
+    def get_tasks(self, force):
+        """
+        Returns the ids and paths of the images to update, a chunk at a time.
+
+        @return: Generator yielding lists of (id, path).
+        @rtype: < [(int, str), ...], ... >
+        """
+        query = CropDusterImage.objects.exclude(image="")
+        if not force:
+            query = query.filter(sha1="")
+        storage = CropDusterImage._meta.get_field('image').storage
+
+        last_id = 0
+        while True:
+            # Paginate by id, since updated rows drop out of the query
+            chunk = list(query.filter(id__gt=last_id).order_by('id')
+                              .values_list('id', 'image')[:CHUNK_SIZE])
+            if not chunk:
+                return
+            last_id = chunk[-1][0]
+            yield [(image_id, storage.path(name)) for image_id, name in chunk]
+
+    def handle(self, *args, **options):
+        """
+        Reads the files in a pool of processes, and stores what they find.
+        """
+        verbosity = int(options.get('verbosity', 1))
+        pool = Pool(max(1, options['procs']), init_worker)
+        updated = 0
+        failures = 0
+        try:
+            for tasks in self.get_tasks(options['force']):
+                for image_id, info, error in pool.imap_unordered(info_task, tasks):
+                    if error is not None:
+                        sys.stderr.write('failed: %s\n' % error)
+                        failures += 1
+                        continue
+
+                    width, height, format, filesize, sha1 = info
+                    CropDusterImage.objects.filter(pk=image_id).update(
+                        width=width, height=height, format=format,
+                        filesize=filesize, sha1=sha1)
+                    updated += 1
+
+                if verbosity > 1:
+                    print "Updated %i images" % updated
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        print "Updated %i images" % updated
+        if failures:
+            raise CommandError("%i images could not be read" % failures)
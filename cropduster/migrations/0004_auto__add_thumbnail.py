@@ -0,0 +1,101 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+    
+    def forwards(self, orm):
+        
+        # Adding model 'Thumbnail'
+        db.create_table('cropduster_thumbnail', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('image', self.gf('django.db.models.fields.related.ForeignKey')(related_name='thumbnails', to=orm['cropduster.Image'])),
+            ('size', self.gf('django.db.models.fields.related.ForeignKey')(related_name='thumbnails', to=orm['cropduster.Size'])),
+            ('source_fingerprint', self.gf('django.db.models.fields.CharField')(max_length=64)),
+            ('crop_x', self.gf('django.db.models.fields.PositiveIntegerField')(null=True, blank=True)),
+            ('crop_y', self.gf('django.db.models.fields.PositiveIntegerField')(null=True, blank=True)),
+            ('crop_w', self.gf('django.db.models.fields.PositiveIntegerField')(null=True, blank=True)),
+            ('crop_h', self.gf('django.db.models.fields.PositiveIntegerField')(null=True, blank=True)),
+            ('size_fingerprint', self.gf('django.db.models.fields.CharField')(max_length=32)),
+        ))
+        db.send_create_signal('cropduster', ['Thumbnail'])
+
+        # Adding unique constraint on 'Thumbnail', fields ['image', 'size']
+        db.create_unique('cropduster_thumbnail', ['image_id', 'size_id'])
+    
+    
+    def backwards(self, orm):
+        
+        # Removing unique constraint on 'Thumbnail', fields ['image', 'size']
+        db.delete_unique('cropduster_thumbnail', ['image_id', 'size_id'])
+
+        # Deleting model 'Thumbnail'
+        db.delete_table('cropduster_thumbnail')
+    
+    
+    models = {
+        'cropduster.crop': {
+            'Meta': {'object_name': 'Crop'},
+            'crop_h': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0', 'null': 'True', 'blank': 'True'}),
+            'crop_w': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0', 'null': 'True', 'blank': 'True'}),
+            'crop_x': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0', 'null': 'True', 'blank': 'True'}),
+            'crop_y': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0', 'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'image': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'images'", 'to': "orm['cropduster.Image']"}),
+            'size': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'size'", 'to': "orm['cropduster.Size']"})
+        },
+        'cropduster.image': {
+            'Meta': {'object_name': 'Image'},
+            'attribution': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'caption': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'image': ('django.db.models.fields.files.ImageField', [], {'max_length': '255', 'db_index': 'True'}),
+            'size_set': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['cropduster.SizeSet']"})
+        },
+        'cropduster.job': {
+            'Meta': {'object_name': 'Job', 'db_table': "'cropduster_job'"},
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'error': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'finished': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'image': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'jobs'", 'to': "orm['cropduster.Image']"}),
+            'object_id': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'started': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'status': ('django.db.models.fields.CharField', [], {'default': "'pending'", 'max_length': '10', 'db_index': 'True'}),
+            'task': ('django.db.models.fields.CharField', [], {'max_length': '10'})
+        },
+        'cropduster.size': {
+            'Meta': {'object_name': 'Size'},
+            'aspect_ratio': ('django.db.models.fields.FloatField', [], {'default': '1'}),
+            'auto_size': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'blank': 'True'}),
+            'create_on_request': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'blank': 'True'}),
+            'height': ('django.db.models.fields.PositiveIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255', 'db_index': 'True'}),
+            'size_set': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['cropduster.SizeSet']"}),
+            'slug': ('django.db.models.fields.SlugField', [], {'max_length': '50', 'db_index': 'True'}),
+            'width': ('django.db.models.fields.PositiveIntegerField', [], {'null': 'True', 'blank': 'True'})
+        },
+        'cropduster.sizeset': {
+            'Meta': {'object_name': 'SizeSet'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255', 'db_index': 'True'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'max_length': '50', 'db_index': 'True'})
+        },
+        'cropduster.thumbnail': {
+            'Meta': {'unique_together': "(('image', 'size'),)", 'object_name': 'Thumbnail', 'db_table': "'cropduster_thumbnail'"},
+            'crop_h': ('django.db.models.fields.PositiveIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'crop_w': ('django.db.models.fields.PositiveIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'crop_x': ('django.db.models.fields.PositiveIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'crop_y': ('django.db.models.fields.PositiveIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'image': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'thumbnails'", 'to': "orm['cropduster.Image']"}),
+            'size': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'thumbnails'", 'to': "orm['cropduster.Size']"}),
+            'size_fingerprint': ('django.db.models.fields.CharField', [], {'max_length': '32'}),
+            'source_fingerprint': ('django.db.models.fields.CharField', [], {'max_length': '64'})
+        }
+    }
+    
+    complete_apps = ['cropduster']
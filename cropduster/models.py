@@ -1,11 +1,16 @@
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.conf import settings
 import os
+import math
+import datetime
 from decimal import Decimal
-from cropduster import utils
+from cropduster import files, jobs, utils, versioning
+from cropduster.registry import registry
+from cropduster.settings import CAP_ORIGINALS, MAX_HEIGHT, MAX_WIDTH, PREVIEW_WIDTH
+from django.core.files.base import ContentFile
 from PIL import Image as pil
 
-IMAGE_SAVE_PARAMS =  {"quality" :95}
+PREVIEW_SAVE_PARAMS = {"quality": 85}
 
 try:
 	from caching.base import CachingMixin, CachingManager
@@ -14,10 +19,104 @@ except ImportError:
 		pass
 	CachingManager = models.Manager
 
+class EncodingProfile(CachingMixin, models.Model):
+	"""
+	How thumbnails are encoded. A size uses its own profile, or else its size
+	set's, or else DEFAULT_ENCODING_PROFILE.
+	"""
+
+	FORMAT_CHOICES = (
+		("", "Same as the original"),
+		("JPEG", "JPEG"),
+		("PNG", "PNG"),
+		("WEBP", "WebP"),
+	)
+	SUBSAMPLING_CHOICES = (
+		(0, "4:4:4"),
+		(1, "4:2:2"),
+		(2, "4:2:0"),
+	)
+	EXTENSIONS = {
+		"JPEG": ".jpg",
+		"PNG": ".png",
+		"WEBP": ".webp",
+	}
+
+	objects = CachingManager()
+
+	name = models.CharField(max_length=255)
+	format = models.CharField(max_length=10, blank=True, choices=FORMAT_CHOICES)
+	quality = models.PositiveIntegerField(default=95)
+	progressive = models.BooleanField(default=False)
+	optimize = models.BooleanField(default=False)
+	subsampling = models.PositiveIntegerField(blank=True, null=True, choices=SUBSAMPLING_CHOICES,
+		help_text="Chroma subsampling of JPEGs. Blank leaves it to the encoder.")
+	strip_metadata = models.BooleanField(default=False, help_text="Leaves out EXIF data and color profiles")
+
+	class Meta:
+		db_table = "cropduster_encodingprofile"
+
+	def __unicode__(self):
+		return u"%s" % self.name
+
+	def get_save_params(self):
+		""" The options passed to PIL when saving """
+		params = {"quality": self.quality}
+		if self.progressive:
+			params["progressive"] = True
+		if self.optimize:
+			params["optimize"] = True
+		if self.subsampling is not None:
+			params["subsampling"] = self.subsampling
+		return params
+
+	def get_extension(self, extension):
+		""" The extension of thumbnails of an original with the given extension """
+		return self.EXTENSIONS.get(self.format, extension)
+
+	def prepare(self, img, format=None):
+		"""
+		Readies a thumbnail for encoding. format is the one it would be saved
+		in without the profile, or None to go by the extension of its path.
+
+		PIL writes the EXIF data and color profile of JPEGs and WebPs only if
+		they are given when saving, so the thumbnail's are passed on unless
+		strip_metadata is set; then they are blanked, as PNGs would otherwise
+		keep theirs.
+
+		@return: (img, format, params) for cropduster.files.save_image
+		"""
+		format = self.format or format
+		params = self.get_save_params()
+		for key in ("exif", "icc_profile"):
+			if self.strip_metadata:
+				params[key] = ""
+			elif img.info.get(key):
+				params[key] = img.info[key]
+		if format == "JPEG" and img.mode not in ("RGB", "L", "CMYK"):
+			img = img.convert("RGB")
+		return img, format, params
+
+	@property
+	def fingerprint_values(self):
+		""" What about the profile goes into the fingerprint of a size """
+		values = [sorted(self.get_save_params().items())]
+		# Left out unless set, so that thumbnails created before profiles
+		# existed stay current
+		if self.format or self.strip_metadata:
+			values.append((self.format, bool(self.strip_metadata)))
+		return values
+
+# Used by sizes that have no profile; encodes as thumbnails always have been
+DEFAULT_ENCODING_PROFILE = EncodingProfile(name="Default")
+
+
 class SizeSet(CachingMixin, models.Model):
 	objects = CachingManager()
 	name = models.CharField(max_length=255, db_index=True)
 	slug = models.SlugField(max_length=50, null=False,)
+	encoding_profile = models.ForeignKey(EncodingProfile, blank=True, null=True,
+		help_text="How the thumbnails of sizes without a profile of their own are encoded")
 	
 	def __unicode__(self):
 		return u"%s" % self.name
@@ -27,12 +126,7 @@ class SizeSet(CachingMixin, models.Model):
 		rather than show every possible thumbnail
 		"""
 		
-		size_query = Size.objects.all().filter(size_set__id=self.id)
-		size_query.query.group_by = ["aspect_ratio"]
-		try:
-			return size_query
-		except ValueError:
-			return None
+		return registry.get_sizes_by_ratio(self.id)
 			
 #	def get_max_size(self):
 #		max_width = 0
@@ -43,16 +137,9 @@ class SizeSet(CachingMixin, models.Model):
 
 class SizeManager(CachingManager):
 	def get_size_by_ratio(self, size_set, aspect_ratio_id):
-		size_query = Size.objects.all().only("aspect_ratio").filter(size_set=size_set).exclude(auto_size=1).order_by("-aspect_ratio")
-		size_query.query.group_by = ["aspect_ratio"]
-
-		try:
-			size = size_query[aspect_ratio_id]
-			
-			# get the largest size with this aspect ratio
-			return Size.objects.all().filter(size_set=size_set, aspect_ratio=size.aspect_ratio, auto_size=False).order_by("-width")[0]
-		except:
-			return None
+		""" Returns the largest size of the size set's nth aspect ratio to crop """
+		step = registry.get_crop_step(getattr(size_set, "pk", size_set), aspect_ratio_id)
+		return step and step.size
 
 class Size(CachingMixin, models.Model):
 	
@@ -68,10 +155,16 @@ class Size(CachingMixin, models.Model):
 	
 	auto_size = models.BooleanField(default=False)
 	
+	create_on_request = models.BooleanField(default=False, verbose_name="Crop on request")
+	
 	size_set = models.ForeignKey(SizeSet)
 	
 	aspect_ratio = models.FloatField(default=1)
 	
+	encoding_profile = models.ForeignKey(EncodingProfile, blank=True, null=True)
+	
+	max_bytes = models.PositiveIntegerField(blank=True, null=True, verbose_name="Max. bytes",
+		help_text="Lowers the quality of thumbnails that would be larger")
 	
 	def save(self, *args, **kwargs):
 		if not self.height or not self.width:
@@ -85,6 +178,23 @@ class Size(CachingMixin, models.Model):
 	
 	def __unicode__(self):
 		return u"%s: %sx%s" % (self.name, self.width, self.height)
+	
+	def get_encoding_profile(self):
+		""" The profile the size's thumbnails are encoded with: its own, its
+		size set's or the default
+		"""
+		if self.pk:
+			return registry.get_encoding_profile(self.pk) or DEFAULT_ENCODING_PROFILE
+		return self.encoding_profile or self.size_set.encoding_profile or DEFAULT_ENCODING_PROFILE
+
+	@property
+	def fingerprint(self):
+		""" Identifies everything about the size that affects its thumbnails """
+		values = [int(self.width or 0), int(self.height or 0), bool(self.auto_size)]
+		values.extend(self.get_encoding_profile().fingerprint_values)
+		if self.max_bytes:
+			values.append(("max_bytes", self.max_bytes))
+		return utils.fingerprint(*values)
 
 class Crop(CachingMixin, models.Model):
 	class Meta:
@@ -109,26 +219,77 @@ class Crop(CachingMixin, models.Model):
 		verbose_name = "images",
 	)
 	
+	def __init__(self, *args, **kwargs):
+		super(Crop, self).__init__(*args, **kwargs)
+		# The crop box as it was loaded, to tell whether a save changes it
+		self._saved_crop_box = self.crop_box if self.pk else False
+
 	def __unicode__(self):
 		return u"%s: %sx%s" % (self.image.image, self.size.width, self.size.height)
 
 
 	def save(self, *args, **kwargs):
+		""" Saves the crop and, unless create_thumbnails=False is given, creates
+		its thumbnails. Leave them to Image.create_crop_thumbnails when saving
+		several of an image's crops. Nothing is created if the crop box is
+		unchanged and its thumbnails are current.
+		"""
+		create_thumbnails = kwargs.pop("create_thumbnails", True)
+		changed = self.crop_box != self._saved_crop_box
 		super(Crop, self).save(*args, **kwargs)
+		self._saved_crop_box = self.crop_box
+		versioning.bump(versioning.image_version(self.image_id))
+		self.job_id = None
+		if create_thumbnails and (changed or self.get_stale_sizes()):
+			self.job_id = jobs.enqueue(jobs.CROP, self.pk, self.image_id)
 
-		if self.size:
-			sizes = Size.objects.all().filter(aspect_ratio=self.size.aspect_ratio, size_set=self.size.size_set).exclude(auto_size=1).order_by("-width")
-			if sizes:
-				cropped_image = utils.create_cropped_image(self.image.image.path, self.crop_x, self.crop_y, self.crop_w, self.crop_h)
-					
-				for size in sizes:
-					
-					thumbnail = utils.rescale(cropped_image, size.width, size.height, crop=size.auto_size)
-	
-					if not os.path.exists(self.image.folder_path):
-						os.makedirs(self.image.folder_path)
-					
-					thumbnail.save(self.image.thumbnail_path(size), **IMAGE_SAVE_PARAMS)
+	@property
+	def crop_box(self):
+		if not (self.crop_w and self.crop_h):
+			return None
+		return (self.crop_x, self.crop_y, self.crop_w, self.crop_h)
+
+	def get_sizes(self):
+		""" Returns the sizes created from this crop, largest first """
+		crop_size = registry.get_size_by_id(self.size_id)
+		step = crop_size and registry.get_crop_step_for(crop_size)
+		if not step:
+			return []
+		return [size for size in step.sizes if not size.create_on_request]
+
+	def get_stale_sizes(self):
+		""" Returns the sizes created from this crop whose thumbnails are out of date """
+		if not self.crop_box:
+			return []
+		return self.image.get_stale_sizes(self.get_sizes(), self.crop_box)
+
+	def create_thumbnails(self, force=False):
+		""" Creates the thumbnails for every size with this crop's aspect ratio
+		that is out of date, or all of them with force=True
+		"""
+		sizes = self.get_sizes()
+		if not sizes:
+			return
+
+		with files.locked(self.image.thumbnail_path(size) for size in sizes):
+			# Checked once the locks are held, in case another process just
+			# created them
+			if not force:
+				sizes = self.get_stale_sizes()
+				if not sizes:
+					return
+
+			# Decode no larger than the largest size needs
+			cropped_image = utils.create_cropped_image(self.image.image.path, self.crop_x, self.crop_y, self.crop_w, self.crop_h,
+				max(size.width or 0 for size in sizes), max(size.height or 0 for size in sizes))
+
+			files.makedirs(self.image.folder_path)
+
+			# Each size is resized from the nearest larger one, not the full crop
+			source = utils.file_fingerprint(self.image.image.path)
+			[rescaled] = utils.rescale_chains([(cropped_image, sizes, False)], self.image.save_thumbnail)
+			for size, thumbnail, quality in rescaled:
+				self.image.record_thumbnail(size, thumbnail, source, self.crop_box, quality)
 
 
 class Image(CachingMixin, models.Model):
@@ -137,30 +298,258 @@ class Image(CachingMixin, models.Model):
 	image = models.ImageField(
 		upload_to=settings.CROPDUSTER_UPLOAD_PATH + "%Y/%m/%d", 
 		max_length=255, 
-		db_index=True
+		db_index=True,
 	)
 	size_set = models.ForeignKey(
 		SizeSet,
 	)
 	attribution = models.CharField(max_length=255, blank=True, null=True)
 	caption = models.CharField(max_length=255, blank=True, null=True)
+	
+	# Stored when the file is uploaded, so it needn't be read to find them out.
+	# Not the ImageField's width_field and height_field, which read the file
+	# whenever a row without them is loaded; update_image_info fills them in
+	# for older rows.
+	width = models.PositiveIntegerField(blank=True, null=True, editable=False)
+	height = models.PositiveIntegerField(blank=True, null=True, editable=False)
+	format = models.CharField(max_length=10, blank=True, editable=False)
+	filesize = models.PositiveIntegerField(blank=True, null=True, editable=False)
+	sha1 = models.CharField(max_length=40, blank=True, editable=False)
+
+	def __init__(self, *args, **kwargs):
+		super(Image, self).__init__(*args, **kwargs)
+		# The file as it was loaded, to tell whether a save replaces it
+		self._saved_image_name = self.image.name if self.pk else None
 
 	def save(self, *args, **kwargs):
+		""" Saves the image and creates the thumbnails of its auto sizes, if the
+		file is new or any of them are out of date. Saves that only change the
+		caption or attribution leave them alone.
+		"""
+		changed = (self.pk is None or not self.image or not self.image._committed
+			or self.image.name != self._saved_image_name)
+
+		if CAP_ORIGINALS and self.image and not self.image._committed:
+			self.cap_original()
+
+		# Only a new file is read; older rows are left to update_image_info
+		if self.image and changed:
+			self.update_file_info()
 
 		super(Image, self).save(*args, **kwargs)
+		self._saved_image_name = self.image.name
+		versioning.bump(versioning.image_version(self.pk))
+		self.job_id = None
+		if changed or self.get_stale_sizes(self.get_auto_sizes()):
+			self.job_id = jobs.enqueue(jobs.IMAGE, self.pk, self.pk)
 
-		for size in self.size_set.size_set.all().filter(auto_size=1):
-			if self.image.width > size.width and self.image.height > size.height:
-				thumbnail = utils.rescale(pil.open(self.image.path), size.width, size.height, crop=True)
-				if not os.path.exists(self.folder_path):
-					os.makedirs(self.folder_path)
-						
-				thumbnail.save(self.thumbnail_path(size), **IMAGE_SAVE_PARAMS)
-			else:
-				thumbnail = pil.open(self.image.path)
-				if not os.path.exists(self.folder_path):
-					os.makedirs(self.folder_path)
-				thumbnail.save(self.thumbnail_path(size), **IMAGE_SAVE_PARAMS)
+	def get_max_dimensions(self):
+		"""
+		Returns the (width, height) that originals are capped to: MAX_WIDTH x
+		MAX_HEIGHT, raised to the largest width and height of the size set's sizes
+		"""
+		max_width, max_height = MAX_WIDTH, MAX_HEIGHT
+		for size in registry.get_sizes(self.size_set_id):
+			max_width = max(max_width, size.width or 0)
+			max_height = max(max_height, size.height or 0)
+		return max_width, max_height
+
+	def cap_original(self):
+		""" Downscales a new upload that is larger than get_max_dimensions(), before
+		it is stored, but never below the size set's required sizes
+		"""
+		max_width, max_height = self.get_max_dimensions()
+		widest, tallest = registry.get_required_sizes(self.size_set_id)
+		data = utils.fit_image(self.image, max_width, max_height,
+			widest and widest.width or 0, tallest and tallest.height or 0,
+			**DEFAULT_ENCODING_PROFILE.get_save_params())
+		if data is not None:
+			self.image.file.close()
+			self.image.file = ContentFile(data)
+
+	def update_file_info(self):
+		""" Reads the image file's dimensions, format, size and hash """
+		self.width, self.height, self.format, self.filesize, self.sha1 = utils.image_file_info(self.image)
+		if self.image._committed:
+			self.image.close()
+
+	def ensure_dimensions(self):
+		""" Returns the original's (width, height). For rows stored before these
+		were, they are read from the file's header and stored; update_image_info
+		fills in the rest. Raises IOError or OSError if the file can't be read.
+		"""
+		if self.width is None or self.height is None:
+			f = open(self.image.path, "rb")
+			try:
+				self.width, self.height, self.format = utils.read_image_header(f)
+			finally:
+				f.close()
+			if self.pk:
+				Image.objects.filter(pk=self.pk).update(width=self.width, height=self.height, format=self.format)
+		return self.width, self.height
+
+	def get_auto_sizes(self):
+		""" Returns the auto sizes of the image's size set that are created up front """
+		return [size for size in registry.get_sizes(self.size_set_id)
+			if size.auto_size and not size.create_on_request]
+
+	def get_stale_sizes(self, sizes, crop_box=None, recorded=None):
+		""" Returns those of the sizes whose thumbnails aren't recorded as created
+		from the current original, cropped to crop_box, at the size as it is now.
+		recorded can give the image's Thumbnails by size id, if already loaded.
+		"""
+		if not sizes or not self.image:
+			return []
+		if recorded is None:
+			recorded = dict((thumbnail.size_id, thumbnail) for thumbnail in
+				Thumbnail.objects.filter(image=self, size__in=[size.pk for size in sizes]))
+		try:
+			source = utils.file_fingerprint(self.image.path)
+		except OSError:
+			# Nothing can be created without the original
+			return []
+		return [size for size in sizes
+			if size.pk not in recorded or not recorded[size.pk].is_current(source, size, crop_box)]
+
+	def create_thumbnails(self, force=False):
+		""" Creates the thumbnails for every auto size in the image's size set
+		that is out of date, or all of them with force=True
+		"""
+		auto_sizes = self.get_auto_sizes()
+		if not auto_sizes:
+			return
+
+		with files.locked(self.thumbnail_path(size) for size in auto_sizes):
+			# Checked once the locks are held, in case another process just
+			# created them
+			if not force:
+				auto_sizes = self.get_stale_sizes(auto_sizes)
+
+			width, height = self.ensure_dimensions()
+			sizes = []
+			for size in auto_sizes:
+				if width > size.width and height > size.height:
+					sizes.append(size)
+				else:
+					self._create_thumbnail(size)
+			if not sizes:
+				return
+
+			# Decode the original once, and rescale each aspect ratio's sizes from
+			# largest to smallest
+			original = utils.open_image(self.image.path,
+				min_width=max(size.width or 0 for size in sizes), min_height=max(size.height or 0 for size in sizes))
+
+			files.makedirs(self.folder_path)
+
+			source = utils.file_fingerprint(self.image.path)
+			chains = [(original, group, True) for group in utils.group_by_aspect_ratio(sizes)]
+			for rescaled in utils.rescale_chains(chains, self.save_thumbnail):
+				for size, thumbnail, quality in rescaled:
+					self.record_thumbnail(size, thumbnail, source, quality=quality)
+
+	def create_crop_thumbnails(self, crops=None, force=False):
+		""" Creates the out of date thumbnails (or all of them, with force=True)
+		for several of the image's crops (by default all of them), decoding the
+		original only once
+		"""
+		if crops is None:
+			crops = Crop.objects.filter(image=self)
+		work = [(crop, crop.get_sizes()) for crop in crops if crop.crop_box]
+		if not work:
+			return
+
+		with files.locked(self.thumbnail_path(size) for crop, sizes in work for size in sizes):
+			# Checked once the locks are held, in case another process just
+			# created them
+			if not force:
+				recorded = dict((thumbnail.size_id, thumbnail) for thumbnail in Thumbnail.objects.filter(image=self))
+				work = [(crop, self.get_stale_sizes(sizes, crop.crop_box, recorded)) for crop, sizes in work]
+			work = [(crop, sizes) for crop, sizes in work if sizes]
+			if not work:
+				return
+
+			# Decode at the scale the most demanding crop needs
+			self.ensure_dimensions()
+			min_width = max(float(self.width) * max(size.width or 0 for size in sizes) / crop.crop_w for crop, sizes in work)
+			min_height = max(float(self.height) * max(size.height or 0 for size in sizes) / crop.crop_h for crop, sizes in work)
+			original = utils.open_image(self.image.path, min_width=int(math.ceil(min_width)), min_height=int(math.ceil(min_height)))
+			scale_x = float(original.size[0]) / self.width
+			scale_y = float(original.size[1]) / self.height
+
+			files.makedirs(self.folder_path)
+
+			source = utils.file_fingerprint(self.image.path)
+			chains = []
+			for crop, sizes in work:
+				x, y, w, h = crop.crop_box
+				cropped_image = original.crop((int(round(x * scale_x)), int(round(y * scale_y)),
+					int(round((x + w) * scale_x)), int(round((y + h) * scale_y))))
+				chains.append((cropped_image, sizes, False))
+
+			for (crop, sizes), rescaled in zip(work, utils.rescale_chains(chains, self.save_thumbnail)):
+				for size, thumbnail, quality in rescaled:
+					self.record_thumbnail(size, thumbnail, source, crop.crop_box, quality)
+
+	def get_crop_box(self, size):
+		""" Returns the box of the crop a size is cut from, or None if the size
+		is auto sized or its aspect ratio hasn't been cropped
+		"""
+		if size.auto_size:
+			return None
+		try:
+			crop = Crop.objects.filter(image=self, size__size_set=self.size_set_id, size__aspect_ratio=size.aspect_ratio)[0]
+		except IndexError:
+			return None
+		return crop.crop_box
+
+	def create_thumbnail(self, size, force=False):
+		""" Creates the thumbnail for a single size from the original, using the
+		crop defined for the size's aspect ratio if there is one. Returns the
+		path the thumbnail was written to. Unless force=True, nothing is written
+		if the thumbnail exists and is up to date, as it will be if another
+		process created it while this one waited for the lock.
+		"""
+		path = self.thumbnail_path(size)
+		with files.locked([path]):
+			crop_box = self.get_crop_box(size)
+			if force or not os.path.exists(path) or self.get_stale_sizes([size], crop_box):
+				self._create_thumbnail(size, crop_box)
+		return path
+
+	def _create_thumbnail(self, size, crop_box=None):
+		""" Writes and records a single thumbnail; the caller holds its lock """
+		if size.auto_size and not (self.width > size.width and self.height > size.height):
+			thumbnail = pil.open(self.image.path)
+		elif crop_box:
+			cropped_image = utils.create_cropped_image(self.image.path, *crop_box, min_width=size.width, min_height=size.height)
+			thumbnail = utils.rescale(cropped_image, size.width, size.height, crop=False)
+		else:
+			original = utils.open_image(self.image.path, min_width=size.width, min_height=size.height)
+			thumbnail = utils.rescale(original, size.width, size.height, crop=True)
+
+		files.makedirs(self.folder_path)
+		quality = self.save_thumbnail(size, thumbnail)
+		self.record_thumbnail(size, thumbnail, utils.file_fingerprint(self.image.path), crop_box, quality)
+
+	def save_thumbnail(self, size, thumbnail):
+		""" Writes a thumbnail to its size's path, encoded with the size's
+		profile and within its max_bytes; called from the resize threads.
+		Returns the quality it was saved at, or None for formats without one.
+		"""
+		filesize, quality = files.save_thumbnail(thumbnail, None, self.thumbnail_path(size), size,
+			size.get_encoding_profile())
+		return quality
+
+	def record_thumbnail(self, size, thumbnail, source, crop_box=None, quality=None):
+		""" Records a thumbnail that was just written in the inventory """
+		path = self.thumbnail_path(size)
+		crop_x, crop_y, crop_w, crop_h = crop_box or (None, None, None, None)
+		Thumbnail.objects.record(self.pk, size.pk,
+			path=path, width=thumbnail.size[0], height=thumbnail.size[1], filesize=os.path.getsize(path),
+			generated=datetime.datetime.now(), source_fingerprint=source,
+			crop_x=crop_x, crop_y=crop_y, crop_w=crop_w, crop_h=crop_h, size_fingerprint=size.fingerprint,
+			quality=quality)
 
 	class Meta:
 		db_table = "cropduster_image"
@@ -181,25 +570,65 @@ class Image(CachingMixin, models.Model):
 	def thumbnail_path(self, size):
 		file_path, file = os.path.split(self.image.path)
 		file_root, extension = os.path.splitext(file)
+		extension = size.get_encoding_profile().get_extension(extension)
 		return u"%s" % os.path.join(file_path, file_root, size.slug) + extension
 		
+	def _url_parts(self):
+		""" The folder url and extension of the image's thumbnails, worked out
+		once per image file
+		"""
+		name = self.image.name
+		parts = getattr(self, "_url_parts_cache", None)
+		if parts is None or parts[0] != name:
+			file_path, file = os.path.split(self.image.url)
+			file_root, extension = os.path.splitext(file)
+			parts = self._url_parts_cache = (name, os.path.join(file_path, file_root), extension)
+		return parts[1:]
+	
 	@property
 	def folder_url(self):
-		file_path, file = os.path.split(self.image.url)
-		file_root, extension = os.path.splitext(file)
-		return u"%s" % os.path.join(file_path, file_root)
+		folder_url, extension = self._url_parts()
+		return u"%s" % folder_url
 		
 	def thumbnail_url(self, size_slug):
-		file_path, file = os.path.split(self.image.url)
-		file_root, extension = os.path.splitext(file)
-		return u"%s" % os.path.join(file_path, file_root, size_slug) + extension
+		folder_url, extension = self._url_parts()
+		size = registry.get_size(self.size_set_id, size_slug)
+		if size is not None:
+			extension = size.get_encoding_profile().get_extension(extension)
+		return u"%s" % os.path.join(folder_url, size_slug) + extension
+	
+	@property
+	def preview_scale(self):
+		""" How many of the original's pixels each pixel of the preview covers """
+		width, height = self.ensure_dimensions()
+		if width > PREVIEW_WIDTH:
+			return float(width) / PREVIEW_WIDTH
+		return 1.0
+	
+	@property
+	def preview_path(self):
+		return os.path.join(self.folder_path, u"_preview%i" % PREVIEW_WIDTH) + self.extension
+	
+	@property
+	def preview_url(self):
+		""" Url of the copy of the original to crop in the admin; the original
+		itself if it is no wider than the preview
+		"""
+		if self.preview_scale == 1:
+			return self.image.url
+		return self.thumbnail_url(u"_preview%i" % PREVIEW_WIDTH)
+	
+	def create_preview(self):
+		""" Writes the reduced copy of the original shown for cropping """
+		if self.preview_scale == 1:
+			return
+		original = utils.open_image(self.image.path, min_width=PREVIEW_WIDTH)
+		preview = utils.rescale(original, PREVIEW_WIDTH, crop=False)
+		files.makedirs(self.folder_path)
+		files.save_image(preview, self.preview_path, **PREVIEW_SAVE_PARAMS)
 		
 	def has_size(self, size_slug):
-		try:
-			size = self.size_set.size_set.get(slug=size_slug)
-			return True
-		except Size.DoesNotExist:
-			return False
+		return registry.get_size(self.size_set_id, size_slug) is not None
 
 	def __unicode__(self):
 		if self.image:
@@ -211,10 +640,139 @@ class Image(CachingMixin, models.Model):
 		return settings.STATIC_URL + self.image
 	
 
+class ThumbnailManager(models.Manager):
+	def record(self, image_id, size_id, **fields):
+		""" Creates or updates the entry for an image's thumbnail of a size.
+		If the thumbnail was written with another extension than before, as
+		when its size's profile changes its format, the old file is deleted.
+		"""
+		entries = self.filter(image=image_id, size=size_id)
+		old_paths = list(entries.values_list("path", flat=True))
+		if not entries.update(**fields):
+			sid = transaction.savepoint()
+			try:
+				self.create(image_id=image_id, size_id=size_id, **fields)
+			except IntegrityError:
+				# Another process created it since the update
+				transaction.savepoint_rollback(sid)
+				entries.update(**fields)
+			else:
+				transaction.savepoint_commit(sid)
+
+		path = fields.get("path")
+		for old_path in old_paths:
+			if path and old_path != path and os.path.splitext(old_path)[0] == os.path.splitext(path)[0]:
+				try:
+					os.remove(old_path)
+				except OSError:
+					pass
+
+class Thumbnail(models.Model):
+	"""
+	The inventory of thumbnails that have been written: where each one is, its
+	dimensions, size in bytes and quality, and what it was last created from: the
+	original (by modification time and size), the crop box, and the size's
+	dimensions and encoding. regenerate_thumbs compares these with the current
+	values to find the thumbnails that are out of date, and the commands and
+	views look thumbnails up here rather than on disk.
+	"""
+	
+	objects = ThumbnailManager()
+	
+	image = models.ForeignKey(
+		"cropduster.Image",
+		related_name = "thumbnails",
+	)
+	size = models.ForeignKey(
+		"cropduster.Size",
+		related_name = "thumbnails",
+	)
+	
+	source_fingerprint = models.CharField(max_length=64)
+	
+	crop_x = models.PositiveIntegerField(blank=True, null=True)
+	crop_y = models.PositiveIntegerField(blank=True, null=True)
+	crop_w = models.PositiveIntegerField(blank=True, null=True)
+	crop_h = models.PositiveIntegerField(blank=True, null=True)
+	
+	size_fingerprint = models.CharField(max_length=32)
+	
+	path = models.CharField(max_length=255, blank=True)
+	width = models.PositiveIntegerField(blank=True, null=True)
+	height = models.PositiveIntegerField(blank=True, null=True)
+	filesize = models.PositiveIntegerField(blank=True, null=True)
+	generated = models.DateTimeField(blank=True, null=True)
+	quality = models.PositiveIntegerField(blank=True, null=True)
+	
+	class Meta:
+		db_table = "cropduster_thumbnail"
+		unique_together = (("image", "size"),)
+	
+	def __unicode__(self):
+		return u"%s: %s" % (self.image_id, self.size_id)
+	
+	@property
+	def crop_box(self):
+		if self.crop_w is None:
+			return None
+		return (self.crop_x, self.crop_y, self.crop_w, self.crop_h)
+
+	def is_current(self, source, size, crop_box=None):
+		""" Whether the thumbnail was created from the original with the given
+		fingerprint, cropped to crop_box, at the size as it is now
+		"""
+		return (self.source_fingerprint == source and self.crop_box == crop_box
+			and self.size_fingerprint == size.fingerprint)
+
+
+class Job(models.Model):
+	""" A queued thumbnail job, for cropduster.jobs.DatabaseBackend """
+	
+	TASK_CHOICES = (
+		(jobs.CROP, "Crop thumbnails"),
+		(jobs.IMAGE, "Image thumbnails"),
+		(jobs.CROPS, "Thumbnails of all crops"),
+	)
+	STATUS_CHOICES = (
+		(jobs.PENDING, "Pending"),
+		(jobs.RUNNING, "Running"),
+		(jobs.DONE, "Done"),
+		(jobs.FAILED, "Failed"),
+	)
+	
+	task = models.CharField(max_length=10, choices=TASK_CHOICES)
+	
+	object_id = models.PositiveIntegerField()
+	
+	image = models.ForeignKey(
+		"cropduster.Image",
+		related_name = "jobs",
+	)
+	
+	status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=jobs.PENDING, db_index=True)
+	
+	error = models.TextField(blank=True)
+	
+	created = models.DateTimeField(auto_now_add=True)
+	started = models.DateTimeField(blank=True, null=True)
+	finished = models.DateTimeField(blank=True, null=True)
+	
+	class Meta:
+		db_table = "cropduster_job"
+	
+	def __unicode__(self):
+		return u"%s %s: %s" % (self.task, self.object_id, self.status)
+
+
 class CropDusterField(models.ForeignKey):
 	pass	
 
 
+for model in (EncodingProfile, Size, SizeSet):
+	models.signals.post_save.connect(registry.invalidate, sender=model)
+	models.signals.post_delete.connect(registry.invalidate, sender=model)
+
+
 try:
 	from south.modelsinspector import add_introspection_rules
 except ImportError:
@@ -0,0 +1,168 @@
+"""
+An in-process registry of sizes and size sets, so looking up a size while
+rendering costs no queries.
+
+The registry is loaded from the database the first time it is used. Saving or
+deleting a Size or SizeSet clears it in the process that did so, and gives the
+"sizes" version in cropduster.versioning a new token. Other processes check
+that token at most every CROPDUSTER_REGISTRY_CHECK_INTERVAL seconds and reload
+when it has changed.
+"""
+import threading
+import time
+from collections import namedtuple
+
+from cropduster import versioning
+from cropduster.settings import REGISTRY_CHECK_INTERVAL
+
+VERSION_NAME = "sizes"
+
+# A step of the upload wizard: an aspect ratio to crop, the largest size with
+# that aspect ratio (which the crop is made for), and all of its sizes, largest
+# first
+CropStep = namedtuple("CropStep", ("aspect_ratio", "size", "sizes"))
+
+# Everything the registry loads, see SizeRegistry._load
+RegistryState = namedtuple("RegistryState", ("size_sets", "sizes", "sizes_by_id", "sizes_by_slug",
+	"sizes_by_ratio", "crop_plans", "required_sizes", "size_profiles"))
+
+
+class SizeRegistry(object):
+
+	# A process can load the registry between the version being bumped and
+	# the change being committed, so reload now and then regardless
+	max_age = 300
+
+	def __init__(self, check_interval=REGISTRY_CHECK_INTERVAL):
+		self.check_interval = check_interval
+		self._lock = threading.Lock()
+		self._state = None
+		self._version = None
+		self._loaded = 0
+		self._checked = 0
+
+	def _load(self):
+		from cropduster.models import EncodingProfile, Size, SizeSet
+
+		profiles = dict((profile.pk, profile) for profile in EncodingProfile.objects.all())
+		size_sets = dict((size_set.pk, size_set) for size_set in SizeSet.objects.all())
+		sizes = dict((size_set_id, []) for size_set_id in size_sets)
+		sizes_by_id = {}
+		sizes_by_slug = {}
+		size_profiles = {}
+		for size in Size.objects.all().order_by("id"):
+			sizes.setdefault(size.size_set_id, []).append(size)
+			sizes_by_id[size.pk] = size
+			sizes_by_slug[(size.size_set_id, size.slug)] = size
+			size_set = size_sets.get(size.size_set_id)
+			size_profiles[size.pk] = (profiles.get(size.encoding_profile_id)
+				or (size_set and profiles.get(size_set.encoding_profile_id)))
+
+		# One size per aspect ratio, and the crop plan: the aspect ratios that
+		# need cropping, in the order they are cropped
+		sizes_by_ratio = {}
+		crop_plans = {}
+		required = {}
+		for size_set_id, size_set_sizes in sizes.items():
+			by_ratio = {}
+			for size in size_set_sizes:
+				by_ratio.setdefault(size.aspect_ratio, size)
+			sizes_by_ratio[size_set_id] = [by_ratio[ratio] for ratio in sorted(by_ratio)]
+
+			to_crop = {}
+			for size in sorted(size_set_sizes, key=lambda size: -(size.width or 0)):
+				if not size.auto_size:
+					to_crop.setdefault(size.aspect_ratio, []).append(size)
+			crop_plans[size_set_id] = [CropStep(ratio, to_crop[ratio][0], to_crop[ratio])
+				for ratio in sorted(to_crop, reverse=True)]
+
+			# The sizes an original must be at least as wide and as tall as
+			fixed = [size for size in size_set_sizes if not size.auto_size]
+			if fixed:
+				required[size_set_id] = (max(fixed, key=lambda size: size.width or 0),
+					max(fixed, key=lambda size: size.height or 0))
+
+		return RegistryState(size_sets, sizes, sizes_by_id, sizes_by_slug, sizes_by_ratio, crop_plans, required,
+			size_profiles)
+
+	def _get_state(self):
+		now = time.time()
+		# Read once, as invalidate() can clear it at any moment
+		state = self._state
+		if state is not None and now - self._checked < self.check_interval:
+			return state
+
+		self._lock.acquire()
+		try:
+			state = self._state
+			if state is None or now - self._checked >= self.check_interval:
+				# Read the version first, so a change made while loading is
+				# picked up by the next check
+				version = versioning.get_version(VERSION_NAME)
+				if state is None or version != self._version or now - self._loaded >= self.max_age:
+					state = self._state = self._load()
+					self._version = version
+					self._loaded = now
+				self._checked = now
+			return state
+		finally:
+			self._lock.release()
+
+	def invalidate(self, **kwargs):
+		""" Clears the registry here and in every other process """
+		versioning.bump(VERSION_NAME)
+		self._state = None
+
+	def get_size_set(self, size_set_id):
+		return self._get_state().size_sets.get(size_set_id)
+
+	def get_sizes(self, size_set_id):
+		""" Returns all of a size set's sizes """
+		return self._get_state().sizes.get(size_set_id, [])
+
+	def get_size_by_id(self, size_id):
+		return self._get_state().sizes_by_id.get(size_id)
+
+	def get_size(self, size_set_id, slug):
+		""" Returns the size with the given slug in a size set, or None """
+		return self._get_state().sizes_by_slug.get((size_set_id, slug))
+
+	def get_sizes_by_ratio(self, size_set_id):
+		""" Returns one of a size set's sizes for each of its aspect ratios """
+		return self._get_state().sizes_by_ratio.get(size_set_id, [])
+
+	def get_crop_plan(self, size_set_id):
+		"""
+		Returns a CropStep for each aspect ratio that is cropped in a size set
+		(those of sizes that aren't auto sized), widest aspect ratio first.
+		"""
+		return self._get_state().crop_plans.get(size_set_id, [])
+
+	def get_required_sizes(self, size_set_id):
+		"""
+		Returns the widest and the tallest of a size set's sizes that aren't
+		auto sized, which an original must be at least as large as, or
+		(None, None) if it has none.
+		"""
+		return self._get_state().required_sizes.get(size_set_id, (None, None))
+
+	def get_crop_step(self, size_set_id, index):
+		""" Returns the index'th step of a size set's crop plan, or None """
+		plan = self.get_crop_plan(size_set_id)
+		if 0 <= index < len(plan):
+			return plan[index]
+		return None
+
+	def get_crop_step_for(self, size):
+		""" Returns the step of the crop plan that crops a size, or None """
+		for step in self.get_crop_plan(size.size_set_id):
+			if step.aspect_ratio == size.aspect_ratio:
+				return step
+		return None
+
+	def get_encoding_profile(self, size_id):
+		""" Returns the profile a size uses, its own or its size set's, or None """
+		return self._get_state().size_profiles.get(size_id)
+
+
+registry = SizeRegistry()
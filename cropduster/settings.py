@@ -1,7 +1,64 @@
 import os.path
+import tempfile
+from django.conf import settings
 
 CROPDUSTER_ROOT = os.path.normpath(os.path.dirname(__file__))
 CROPDUSTER_MEDIA_ROOT = os.path.join(CROPDUSTER_ROOT, 'media')
 
-MAX_WIDTH = 1000
-MAX_HEIGHT = 1000
\ No newline at end of file
+# With CAP_ORIGINALS on, uploaded originals larger than MAX_WIDTH x MAX_HEIGHT
+# are downscaled to fit before they are stored. The cap is raised as needed to
+# keep originals as large as the largest size in their size set.
+CAP_ORIGINALS = getattr(settings, "CROPDUSTER_CAP_ORIGINALS", False)
+MAX_WIDTH = getattr(settings, "CROPDUSTER_MAX_WIDTH", 1000)
+MAX_HEIGHT = getattr(settings, "CROPDUSTER_MAX_HEIGHT", 1000)
+
+# Uploads larger than this many megapixels or bytes are turned away before
+# they are decoded. 0 turns either check off.
+MAX_UPLOAD_MEGAPIXELS = getattr(settings, "CROPDUSTER_MAX_UPLOAD_MEGAPIXELS", 100)
+MAX_UPLOAD_BYTES = getattr(settings, "CROPDUSTER_MAX_UPLOAD_BYTES", 100 * 1024 * 1024)
+
+# Where chunked uploads are assembled, and how many seconds an upload can go
+# without a chunk before it is thrown away. Keep the directory on the same
+# filesystem as MEDIA_ROOT, so finished uploads are moved rather than copied.
+CHUNKED_UPLOAD_DIR = getattr(settings, "CROPDUSTER_CHUNKED_UPLOAD_DIR",
+	os.path.join(getattr(settings, "FILE_UPLOAD_TEMP_DIR", None) or tempfile.gettempdir(), "cropduster"))
+CHUNKED_UPLOAD_EXPIRY = getattr(settings, "CROPDUSTER_CHUNKED_UPLOAD_EXPIRY", 24 * 60 * 60)
+
+# Where the lock files that keep two processes from creating the same
+# thumbnail at once are kept. See cropduster.files.
+LOCK_DIR = getattr(settings, "CROPDUSTER_LOCK_DIR", os.path.join(tempfile.gettempdir(), "cropduster-locks"))
+
+# Width of the reduced copy of an original shown for cropping in the admin
+PREVIEW_WIDTH = getattr(settings, "CROPDUSTER_PREVIEW_WIDTH", 800)
+
+# A thumbnail is rescaled from a larger thumbnail of the same crop (rather than
+# from the crop itself) only if the larger one is at least this many times its
+# size in both dimensions. 1 always uses the next larger thumbnail. Originals
+# decoded at a reduced scale are kept at least this much larger than the
+# largest size too.
+RESIZE_QUALITY_GUARD = getattr(settings, "CROPDUSTER_RESIZE_QUALITY_GUARD", 1.5)
+
+# The lowest quality the encoder goes down to when fitting a thumbnail into
+# its size's max_bytes
+MIN_QUALITY = getattr(settings, "CROPDUSTER_MIN_QUALITY", 30)
+
+# Number of threads shared by the thumbnail creation of each process, which
+# rescale and encode an image's sizes in parallel. 1 does it all serially.
+RESIZE_THREADS = getattr(settings, "CROPDUSTER_RESIZE_THREADS", 4)
+
+# Backend that Image.save() and Crop.save() hand thumbnail creation to, and
+# the number of workers for the in-process pool backends. See cropduster.jobs.
+JOB_BACKEND = getattr(settings, "CROPDUSTER_JOB_BACKEND", "cropduster.jobs.ImmediateBackend")
+JOB_WORKERS = getattr(settings, "CROPDUSTER_JOB_WORKERS", 2)
+
+# How often, in seconds, each process checks the cache for changes to sizes
+# made by other processes. See cropduster.registry.
+REGISTRY_CHECK_INTERVAL = getattr(settings, "CROPDUSTER_REGISTRY_CHECK_INTERVAL", 5)
+
+# Render the get_image tag's bundled templates (image.html and html4.html) by
+# formatting their markup directly, skipping the template engine. Leave off if
+# the project overrides those templates.
+TEMPLATE_FAST_PATH = getattr(settings, "CROPDUSTER_TEMPLATE_FAST_PATH", False)
+
+# Seconds to cache the get_image tag's output for. 0 turns the cache off.
+TEMPLATE_CACHE_TIMEOUT = getattr(settings, "CROPDUSTER_TEMPLATE_CACHE_TIMEOUT", 0)
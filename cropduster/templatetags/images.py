@@ -2,32 +2,62 @@ from coffin import template
 from coffin.template.loader import get_template
 register = template.Library()
 from django.conf import settings
-from cropduster.models import Size
+from django.core.cache import cache
+from jinja2 import escape
+from cropduster import batch, utils, versioning
+from cropduster.registry import VERSION_NAME as SIZES_VERSION, registry
+from cropduster.settings import TEMPLATE_CACHE_TIMEOUT, TEMPLATE_FAST_PATH
 
+# Markup of the bundled templates, for rendering them without the template
+# engine. Each maps to the element the attribution is shown in.
+FAST_TEMPLATES = {
+	"image.html": u'<figcaption>%s</figcaption>',
+	"html4.html": u'<div class="credit">%s</div>',
+}
 
-image_sizes = Size.objects.all()
-image_size_map = {}
-for size in image_sizes:
-	image_size_map[(size.size_set_id, size.slug)] = size
+
+def render_fast(template_name, context):
+	""" Formats the markup of one of the FAST_TEMPLATES directly """
+	attrs = [u'src="%s"' % escape(context["image_url"]), u'alt="%s"' % escape(context["alt"]),
+		u'title="%s"' % escape(context["title"])]
+	for name in ("class", "height", "width"):
+		if context.get(name):
+			attrs.append(u'%s="%s"' % (name, escape(context[name])))
+	html = u"<img %s />" % u" ".join(attrs)
+
+	if context["attribution"] and context.get("attribute"):
+		html += u"\n" + FAST_TEMPLATES[template_name] % escape(context["attribution"])
+	return html
 
 
 @register.object
 def get_image(image, size_name="large", template_name="image.html", width=None, height=None, **kwargs):
 
 	if image:
-		
+
+		image_size = registry.get_size(image.size_set_id, size_name)
+		if image_size is None:
+			return ""
+
+		# Cached markup is dropped when the image, its crops or its sizes change
+		if TEMPLATE_CACHE_TIMEOUT and image.pk:
+			cache_key = "cropduster.get_image.%s" % utils.fingerprint(image.pk, size_name, template_name,
+				width, height, sorted(kwargs.items()),
+				versioning.get_versions(SIZES_VERSION, versioning.image_version(image.pk)))
+			html = cache.get(cache_key)
+			if html is not None:
+				return html
+		else:
+			cache_key = None
+
 		image_url = image.thumbnail_url(size_name)
 		if image_url is None or image_url == "":
 			return ""
-		try:
-			image_size = image_size_map[(image.size_set_id,size_name)]
-		except KeyError:
-			return ""
-	
-		kwargs["image_url"] = image_url			
+
+		kwargs["image_url"] = image_url
 		kwargs["width"] = width or image_size.width or ""
 		kwargs["height"] = height or image_size.height  or ""
-		
+
 
 		if hasattr(settings, "CROPDUSTER_KITTY_MODE") and settings.CROPDUSTER_KITTY_MODE:
 			kwargs["image_url"] = "http://placekitten.com/{0}/{1}".format(kwargs["width"], kwargs["height"])
@@ -36,15 +66,29 @@ def get_image(image, size_name="large", template_name="image.html", width=None,
 		kwargs["attribution"] = image.attribution
 		kwargs["alt"] = kwargs["alt"] if "alt" in kwargs else image.caption
 		kwargs["title"] = kwargs["title"] if "title" in kwargs else kwargs["alt"]
-			
 
 
-		tpl = get_template("templatetags/" + template_name)
-		ctx = template.Context(kwargs)
-		return tpl.render(ctx)
+		if TEMPLATE_FAST_PATH and template_name in FAST_TEMPLATES:
+			html = render_fast(template_name, kwargs)
+		else:
+			tpl = get_template("templatetags/" + template_name)
+			ctx = template.Context(kwargs)
+			html = tpl.render(ctx)
+
+		if cache_key:
+			cache.set(cache_key, html, TEMPLATE_CACHE_TIMEOUT)
+		return html
 	else:
 		return ""
 
-	
-		
-		
\ No newline at end of file
+
+@register.object
+def get_images(objects, size_name="large", field_name=None):
+	"""
+	Pairs each object with its thumbnail of the given size, as a (url, width,
+	height) tuple or None, loading all of their images with one query:
+
+		{% for obj, thumbnail in get_images(object_list, "small") %}
+	"""
+	objects = list(objects)
+	return zip(objects, batch.get_thumbnails(objects, size_name, field_name))
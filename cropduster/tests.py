@@ -0,0 +1,594 @@
+import hashlib
+import os
+import shutil
+import tarfile
+import tempfile
+from cStringIO import StringIO
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.management.base import CommandError
+from django.core.urlresolvers import reverse
+from django.db import models
+from django.db.models.query import QuerySet
+from django.test import TestCase
+from django.utils import simplejson
+from PIL import Image as pil
+
+from cropduster import batch, chunked, files, jobs, utils
+from cropduster.backup import MANIFEST_NAME, ORIGINAL, Entry, format_entry
+from cropduster.management.commands import restore_images
+from cropduster.registry import registry
+from cropduster.views import CropForm
+from cropduster.models import DEFAULT_ENCODING_PROFILE, Crop, CropDusterField, EncodingProfile, Image, Job, Size, SizeSet, Thumbnail
+
+
+class Article(models.Model):
+	""" A model with a cropduster image, as an app would have """
+	image = CropDusterField(Image, blank=True, null=True)
+
+
+class CropDusterTestCase(TestCase):
+	"""
+	Creates size sets and images through their models' save(), as the admin
+	does, with the images' files written to the test MEDIA_ROOT.
+	"""
+
+	def login_staff(self):
+		user = User.objects.create_user("staff", "staff@example.com", "password")
+		user.is_staff = True
+		user.save()
+		self.client.login(username="staff", password="password")
+
+	def create_size_set(self, *sizes):
+		""" Creates a size set with the given (slug, width, height) sizes """
+		size_set = SizeSet.objects.create(name="Test", slug="test")
+		for slug, width, height in sizes:
+			Size.objects.create(name=slug, slug=slug, width=width, height=height, size_set=size_set)
+		return size_set
+
+	def image_data(self, width, height, format="JPEG"):
+		f = StringIO()
+		pil.new("RGB", (width, height), (255, 0, 0)).save(f, format)
+		return f.getvalue()
+
+	def create_image(self, size_set, width=400, height=300, **fields):
+		image = Image(size_set=size_set, **fields)
+		image.image.save("test.jpg", ContentFile(self.image_data(width, height)), save=False)
+		image.save()
+		return image
+
+	def create_legacy_image(self, size_set, name="cropduster/legacy.jpg"):
+		""" A row as stored before the file's details were, saved without
+		Image.save so its file isn't read
+		"""
+		image = Image(image=name, size_set=size_set)
+		models.Model.save(image)
+		return image
+
+
+class ChunkedUploadTest(CropDusterTestCase):
+
+	def setUp(self):
+		self.login_staff()
+		self.size_set = self.create_size_set()
+		self.data = self.image_data(200, 100)
+		self.half = len(self.data) // 2
+
+	def init(self, **kwargs):
+		data = {"name": "test.jpg", "size": len(self.data), "size_set": self.size_set.pk}
+		data.update(kwargs)
+		return self.client.post(reverse("cropduster-upload-init"), data)
+
+	def start(self):
+		return simplejson.loads(self.init().content)["upload_id"]
+
+	def send(self, upload_id, offset, data):
+		return self.client.post(reverse("cropduster-upload-chunk", args=[upload_id]) + "?offset=%i" % offset,
+			data, content_type="application/octet-stream")
+
+	def offset(self, upload_id):
+		response = self.client.get(reverse("cropduster-upload-chunk", args=[upload_id]))
+		return simplejson.loads(response.content)["offset"]
+
+	def finalize(self, upload_id):
+		return self.client.post(reverse("cropduster-upload-finalize", args=[upload_id]))
+
+	def test_init(self):
+		response = self.init()
+		self.assertEqual(response.status_code, 200)
+		data = simplejson.loads(response.content)
+		self.assertEqual(data["offset"], 0)
+		info = chunked.get_info(data["upload_id"])
+		self.assertEqual(info["name"], "test.jpg")
+		self.assertEqual(info["size"], len(self.data))
+		self.assertEqual(chunked.get_offset(data["upload_id"]), 0)
+
+	def test_init_needs_size(self):
+		self.assertEqual(self.init(size=0).status_code, 400)
+
+	def test_init_needs_staff(self):
+		self.client.logout()
+		response = self.init()
+		self.assertFalse("upload_id" in response.content)
+
+	def test_append(self):
+		upload_id = self.start()
+		response = self.send(upload_id, 0, self.data[:self.half])
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(simplejson.loads(response.content)["offset"], self.half)
+		self.assertEqual(self.offset(upload_id), self.half)
+
+	def test_resume(self):
+		upload_id = self.start()
+		self.send(upload_id, 0, self.data[:self.half])
+
+		# As after a dropped connection: ask where to carry on from
+		offset = self.offset(upload_id)
+		response = self.send(upload_id, offset, self.data[offset:])
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(simplejson.loads(response.content)["offset"], len(self.data))
+
+	def test_wrong_offset(self):
+		upload_id = self.start()
+		self.send(upload_id, 0, self.data[:self.half])
+
+		# The same chunk again is turned away, with the offset to resume from
+		response = self.send(upload_id, 0, self.data[:self.half])
+		self.assertEqual(response.status_code, 409)
+		self.assertEqual(simplejson.loads(response.content)["offset"], self.half)
+		self.assertEqual(chunked.get_offset(upload_id), self.half)
+
+	def test_past_the_end(self):
+		upload_id = self.start()
+		response = self.send(upload_id, 0, self.data + "extra")
+		self.assertEqual(response.status_code, 409)
+		self.assertEqual(chunked.get_offset(upload_id), 0)
+
+	def test_finalize_incomplete(self):
+		upload_id = self.start()
+		self.send(upload_id, 0, self.data[:self.half])
+		response = self.finalize(upload_id)
+		self.assertEqual(response.status_code, 409)
+		self.assertEqual(Image.objects.count(), 0)
+
+	def test_finalize(self):
+		upload_id = self.start()
+		self.send(upload_id, 0, self.data[:self.half])
+		self.send(upload_id, self.half, self.data[self.half:])
+		upload = chunked.get_file(upload_id)
+		part = os.stat(upload.temporary_file_path())
+		upload.close()
+
+		response = self.finalize(upload_id)
+		self.assertEqual(response.status_code, 200)
+		image = Image.objects.get(pk=simplejson.loads(response.content)["image_id"])
+
+		# Moved into place, not copied
+		self.assertEqual(os.stat(image.image.path).st_ino, part.st_ino)
+		self.assertEqual((image.width, image.height, image.format), (200, 100, "JPEG"))
+		self.assertEqual(image.filesize, len(self.data))
+		self.assertEqual(open(image.image.path, "rb").read(), self.data)
+
+		# The upload's files are gone
+		self.assertEqual(chunked.get_info(upload_id), None)
+
+
+class FitImageTest(TestCase):
+
+	def image_file(self, width, height):
+		f = StringIO()
+		pil.new("RGB", (width, height)).save(f, "JPEG")
+		f.seek(0)
+		return f
+
+	def fit(self, *args, **kwargs):
+		data = utils.fit_image(*args, **kwargs)
+		return data and pil.open(StringIO(data)).size
+
+	def test_fits_within(self):
+		self.assertEqual(self.fit(self.image_file(4000, 3000), 1000, 1000), (1000, 750))
+
+	def test_leaves_small_images(self):
+		self.assertEqual(self.fit(self.image_file(800, 600), 1000, 1000), None)
+
+	def test_keeps_required_size(self):
+		# A 1000 x 1000 crop has to fit in the capped image
+		self.assertEqual(self.fit(self.image_file(4000, 3000), 1000, 1000, 1000, 1000), (1333, 1000))
+		self.assertEqual(self.fit(self.image_file(1200, 900), 1000, 1000, 1000, 1000), None)
+
+
+class ChainSize(object):
+
+	def __init__(self, width, height, aspect_ratio=1, max_bytes=None):
+		self.width, self.height, self.aspect_ratio = width, height, aspect_ratio
+		self.max_bytes = max_bytes
+
+
+class PlanChainTest(TestCase):
+
+	def sources(self, sizes):
+		return [source for size, source in utils.plan_chain((4000, 3000), sizes, 2)]
+
+	def test_chains_from_larger(self):
+		self.assertEqual(self.sources([ChainSize(400, 300), ChainSize(1600, 1200), ChainSize(100, 75)]),
+			[None, 0, 1])
+
+	def test_free_size_from_image(self):
+		# Only a width: not from a size cropped to a fixed ratio
+		self.assertEqual(self.sources([ChainSize(1600, 1600), ChainSize(200, None)]), [None, None])
+		self.assertEqual(self.sources([ChainSize(1600, None), ChainSize(None, 100)]), [None, 0])
+
+	def test_groups_free_sizes_apart(self):
+		square, wide, free = ChainSize(100, 100), ChainSize(160, 90, 1.78), ChainSize(200, None)
+		self.assertEqual(len(utils.group_by_aspect_ratio([square, wide, free])), 3)
+
+
+class EncodeWithinTest(TestCase):
+
+	def setUp(self):
+		# Noise, which doesn't compress
+		self.img = pil.frombytes("RGB", (64, 64), os.urandom(64 * 64 * 3))
+
+	def test_fits(self):
+		data, quality = utils.encode_within(self.img, "JPEG", 1 << 20, quality=90)
+		self.assertEqual(quality, 90)
+
+	def test_lowers_quality(self):
+		high = len(utils.encode_within(self.img, "JPEG", 1 << 20, quality=90)[0])
+		data, quality = utils.encode_within(self.img, "JPEG", high - 1, quality=90)
+		self.assertTrue(len(data) < high)
+		self.assertTrue(quality < 90)
+
+	def test_no_quality_setting(self):
+		data, quality = utils.encode_within(self.img, "PNG", 100, quality=90)
+		self.assertEqual(quality, None)
+
+
+class SaveThumbnailTest(TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.img = pil.frombytes("RGB", (64, 64), os.urandom(64 * 64 * 3))
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def save(self, name, max_bytes=None):
+		path = os.path.join(self.dir, name)
+		filesize, quality = files.save_thumbnail(self.img, None, path, ChainSize(64, 64, max_bytes=max_bytes),
+			DEFAULT_ENCODING_PROFILE)
+		self.assertEqual(filesize, os.path.getsize(path))
+		return filesize, quality
+
+	def test_quality(self):
+		self.assertEqual(self.save("a.jpg")[1], 95)
+		self.assertEqual(self.save("a.png")[1], None)
+
+	def test_max_bytes(self):
+		filesize, quality = self.save("a.jpg", 4000)
+		self.assertTrue(filesize <= 4000)
+		self.assertTrue(quality < 95)
+		self.assertEqual(self.save("a.png", 100000)[1], None)
+
+
+class ImageInfoTest(CropDusterTestCase):
+
+	def setUp(self):
+		# A row from before file info was stored, whose file has gone
+		self.size_set = self.create_size_set()
+		self.image_id = self.create_legacy_image(self.size_set, "cropduster/missing.jpg").pk
+
+	def test_stored_on_upload(self):
+		image = self.create_image(self.size_set, 200, 100)
+		stored = Image.objects.get(pk=image.pk)
+		self.assertEqual((stored.width, stored.height, stored.format), (200, 100, "JPEG"))
+		self.assertEqual(stored.filesize, os.path.getsize(image.image.path))
+		self.assertEqual(len(stored.sha1), 40)
+
+	def test_load_without_file(self):
+		image = Image.objects.get(pk=self.image_id)
+		self.assertEqual(image.width, None)
+
+	def test_save_caption_without_file(self):
+		image = Image.objects.get(pk=self.image_id)
+		image.caption = "Caption"
+		image.save()
+		self.assertEqual(Image.objects.get(pk=self.image_id).caption, "Caption")
+		self.assertEqual(image.job_id, None)
+
+	def test_reads_missing_dimensions(self):
+		# Its file is there, but its dimensions weren't stored
+		path = os.path.join(settings.MEDIA_ROOT, "cropduster", "legacy.jpg")
+		if not os.path.exists(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		pil.new("RGB", (200, 100)).save(path, "JPEG")
+		Image.objects.filter(pk=self.image_id).update(image="cropduster/legacy.jpg")
+
+		image = Image.objects.get(pk=self.image_id)
+		self.assertEqual(image.ensure_dimensions(), (200, 100))
+		stored = Image.objects.get(pk=self.image_id)
+		self.assertEqual((stored.width, stored.height, stored.format), (200, 100, "JPEG"))
+
+	def test_missing_dimensions_without_file(self):
+		self.assertRaises(IOError, Image.objects.get(pk=self.image_id).ensure_dimensions)
+
+
+class SaveJobsTest(CropDusterTestCase):
+	""" Which saves queue thumbnail jobs, in the database so they can be seen """
+
+	def setUp(self):
+		jobs._backend = jobs.DatabaseBackend()
+		self.size_set = self.create_size_set(("square", 100, 100))
+		Size.objects.create(name="auto", slug="auto", width=50, height=50, auto_size=True, size_set=self.size_set)
+		self.image = self.create_image(self.size_set)
+		self.run_jobs()
+
+	def tearDown(self):
+		jobs._backend = None
+
+	def run_jobs(self):
+		while jobs.run_next_job():
+			pass
+
+	def test_new_image(self):
+		self.assertNotEqual(self.image.job_id, None)
+		self.assertEqual(Thumbnail.objects.filter(image=self.image, size__slug="auto").count(), 1)
+
+	def test_caption_only(self):
+		image = Image.objects.get(pk=self.image.pk)
+		image.caption = "Caption"
+		image.save()
+		self.assertEqual(image.job_id, None)
+
+	def test_new_file(self):
+		image = Image.objects.get(pk=self.image.pk)
+		image.image.save("new.jpg", ContentFile(self.image_data(300, 200)), save=False)
+		image.save()
+		self.assertNotEqual(image.job_id, None)
+
+	def test_crop(self):
+		crop = Crop(image=self.image, size=Size.objects.get(slug="square"), crop_x=0, crop_y=0, crop_w=200, crop_h=200)
+		crop.save()
+		self.assertNotEqual(crop.job_id, None)
+		self.run_jobs()
+
+		# The same box again
+		crop = Crop.objects.get(pk=crop.pk)
+		crop.save()
+		self.assertEqual(crop.job_id, None)
+
+		crop.crop_x = 100
+		crop.save()
+		self.assertNotEqual(crop.job_id, None)
+
+
+class CropFormTest(CropDusterTestCase):
+
+	def setUp(self):
+		self.image = self.create_image(self.create_size_set(("square", 100, 100)))
+		self.size = Size.objects.get(slug="square")
+
+	def form(self, w, h):
+		return CropForm({"crop_x": 0, "crop_y": 0, "crop_w": w, "crop_h": h,
+			"size": self.size.pk, "image": self.image.pk})
+
+	def test_covers_size(self):
+		self.assertTrue(self.form(100, 100).is_valid())
+		self.assertTrue(self.form(300, 200).is_valid())
+
+	def test_smaller_than_size(self):
+		# As a crop at the preview's minimum can come back a pixel short
+		self.assertFalse(self.form(99, 100).is_valid())
+		self.assertFalse(self.form(100, 99).is_valid())
+
+
+class UploadWizardTest(CropDusterTestCase):
+
+	def setUp(self):
+		self.login_staff()
+		self.image = self.create_image(self.create_size_set(("wide", 200, 100), ("square", 100, 100)))
+
+	def tearDown(self):
+		jobs._backend = None
+
+	def crop(self, aspect_ratio_id, w, h):
+		return self.client.post(reverse("cropduster-upload") + "?size_set=%i&image_element_id=id_image" % self.image.size_set_id, {
+			"image_id": self.image.pk, "aspect_ratio_id": aspect_ratio_id,
+			"crop_x": 0, "crop_y": 0, "crop_w": w, "crop_h": h,
+		})
+
+	def test_thumbnails_as_each_crop_is_saved(self):
+		self.crop(0, 400, 200)
+		self.assertEqual(list(Thumbnail.objects.values_list("size__slug", flat=True)), ["wide"])
+
+	def test_one_job_for_the_crops(self):
+		jobs._backend = jobs.DatabaseBackend()
+		self.crop(0, 400, 200)
+		self.crop(1, 300, 300)
+		self.assertEqual(Crop.objects.count(), 2)
+		self.assertEqual(list(Job.objects.values_list("task", flat=True)), [jobs.CROPS])
+
+
+class CropsViewTest(CropDusterTestCase):
+
+	def setUp(self):
+		self.login_staff()
+		self.image = self.create_image(self.create_size_set(("square", 100, 100)))
+
+	def post(self, **crop):
+		values = {"aspect_ratio_id": 0, "crop_x": 0, "crop_y": 0, "crop_w": 200, "crop_h": 200}
+		values.update(crop)
+		return self.client.post(reverse("cropduster-crops"),
+			simplejson.dumps({"image_id": self.image.pk, "crops": [values]}), content_type="application/json")
+
+	def test_needs_staff(self):
+		self.client.logout()
+		response = self.post()
+		self.assertFalse("job_id" in response.content)
+		self.assertEqual(Crop.objects.count(), 0)
+
+	def test_empty_crop(self):
+		for crop in ({"crop_w": 0}, {"crop_h": 0}, {"crop_w": -10, "crop_x": 20}):
+			response = self.post(**crop)
+			self.assertEqual(response.status_code, 400)
+			self.assertTrue("must be positive" in response.content)
+		self.assertEqual(Crop.objects.count(), 0)
+
+
+class EncodingProfileTest(CropDusterTestCase):
+
+	# An empty big-endian TIFF directory, and a stand-in color profile
+	EXIF = "Exif\x00\x00MM\x00*\x00\x00\x00\x08\x00\x00\x00\x00\x00\x00"
+	ICC = "icc profile"
+
+	def thumbnail(self, format, **profile):
+		""" Encodes a thumbnail of an original with metadata, and decodes it """
+		f = StringIO()
+		pil.new("RGB", (40, 40)).save(f, format, exif=self.EXIF, icc_profile=self.ICC)
+		f.seek(0)
+		img = pil.open(f).resize((20, 20))
+
+		img, format, params = EncodingProfile(**profile).prepare(img, format)
+		out = StringIO()
+		img.save(out, format, **params)
+		out.seek(0)
+		return pil.open(out)
+
+	def test_keeps_metadata(self):
+		info = self.thumbnail("JPEG").info
+		self.assertEqual((info.get("exif"), info.get("icc_profile")), (self.EXIF, self.ICC))
+		self.assertEqual(self.thumbnail("PNG").info.get("icc_profile"), self.ICC)
+
+	def test_strip_metadata(self):
+		for format in ("JPEG", "PNG"):
+			info = self.thumbnail(format, strip_metadata=True).info
+			self.assertEqual((info.get("exif"), info.get("icc_profile")), (None, None))
+
+	def test_format_change_replaces_old_file(self):
+		image = self.create_image(self.create_size_set(("small", 10, 10)))
+		size = Size.objects.get(slug="small")
+
+		old_path, new_path = [os.path.join(settings.MEDIA_ROOT, "small" + extension) for extension in (".jpg", ".webp")]
+		for path in (old_path, new_path):
+			open(path, "wb").close()
+		Thumbnail.objects.record(image.pk, size.pk, path=old_path, source_fingerprint="", size_fingerprint="")
+		Thumbnail.objects.record(image.pk, size.pk, path=new_path, source_fingerprint="", size_fingerprint="")
+
+		self.assertEqual(Thumbnail.objects.get(image=image).path, new_path)
+		self.assertFalse(os.path.exists(old_path))
+		self.assertTrue(os.path.exists(new_path))
+
+
+class ThumbnailRecordTest(CropDusterTestCase):
+
+	def setUp(self):
+		self.image = self.create_image(self.create_size_set(("small", 10, 10)))
+		self.size = Size.objects.get(slug="small")
+
+	def record(self, **fields):
+		Thumbnail.objects.record(self.image.pk, self.size.pk, source_fingerprint="", size_fingerprint="", **fields)
+
+	def test_created_meanwhile(self):
+		self.record(width=1)
+
+		# As if another process created the entry after the update found none
+		update = QuerySet.update
+		def racing_update(queryset, **fields):
+			QuerySet.update = update
+			return 0
+		QuerySet.update = racing_update
+		try:
+			self.record(width=2)
+		finally:
+			QuerySet.update = update
+
+		self.assertEqual(list(Thumbnail.objects.values_list("width", flat=True)), [2])
+
+
+class DatabaseBackendTest(CropDusterTestCase):
+
+	def test_status(self):
+		image = self.create_image(self.create_size_set())
+		backend = jobs.DatabaseBackend()
+		job_id = backend.enqueue(jobs.IMAGE, image.pk, image.pk)
+		self.assertEqual(backend.status(job_id), jobs.PENDING)
+		self.assertEqual(backend.status(str(job_id)), jobs.PENDING)
+
+	def test_unknown_job(self):
+		backend = jobs.DatabaseBackend()
+		for job_id in (12345, "abc", "", None):
+			self.assertEqual(backend.status(job_id), None)
+
+
+class RestoreImagesTest(TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.root = os.path.join(self.dir, "root")
+		self.files = {"images/a.jpg": "a" * 10, "images/b.jpg": "b" * 20}
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def backup(self, names):
+		""" Archives the named files, with a manifest of all of them """
+		path = os.path.join(self.dir, "backup.tar")
+		tar = tarfile.open(path, "w")
+		manifest = ""
+		for name, data in sorted(self.files.items()):
+			manifest += format_entry(Entry(ORIGINAL, len(data), 1000, hashlib.sha1(data).hexdigest(), u"/" + name))
+			if name in names:
+				info = tarfile.TarInfo(name)
+				info.size, info.mtime = len(data), 1000
+				tar.addfile(info, StringIO(data))
+		info = tarfile.TarInfo(MANIFEST_NAME)
+		info.size = len(manifest)
+		tar.addfile(info, StringIO(manifest))
+		tar.close()
+		return path
+
+	def restore(self, path):
+		restore_images.Command().handle(backup_file=path, manifest=None, decompress_program=None,
+			root=self.root, workers=2, only_origs=False, regenerate=False)
+
+	def test_restores(self):
+		self.restore(self.backup(self.files))
+		self.assertEqual(open(os.path.join(self.root, "images/b.jpg")).read(), self.files["images/b.jpg"])
+
+	def test_missing_from_archive(self):
+		self.assertRaises(CommandError, self.restore, self.backup(["images/a.jpg"]))
+
+	def test_left_out_of_incremental(self):
+		# b.jpg is already in place from an earlier backup
+		path = os.path.join(self.root, "images/b.jpg")
+		os.makedirs(os.path.dirname(path))
+		open(path, "wb").write(self.files["images/b.jpg"])
+		os.utime(path, (1000, 1000))
+		self.restore(self.backup(["images/a.jpg"]))
+
+
+class BatchTest(CropDusterTestCase):
+
+	def setUp(self):
+		size_set = self.create_size_set(("small", 100, 100))
+		image = self.create_image(size_set)
+		for i in range(10):
+			Article.objects.create(image=self.create_image(size_set) if i % 2 else image)
+		Article.objects.create()
+
+		# Loaded once per process, not per page
+		registry.get_size_set(size_set.pk)
+
+	def test_constant_queries(self):
+		for count in (2, 11):
+			articles = list(Article.objects.order_by("pk")[:count])
+			with self.assertNumQueries(1):
+				thumbnails = batch.get_thumbnails(articles, "small")
+				for article in articles:
+					article.image and article.image.size_set
+			self.assertEqual(len(thumbnails), count)
+
+		self.assertEqual(thumbnails[-1], None)
+		self.assertEqual(thumbnails[0], (articles[0].image.thumbnail_url("small"), 100, 100))
@@ -5,4 +5,14 @@ urlpatterns = patterns('',
 	url(r'^_static/(?P<path>.*)$', "django.views.static.serve", {"document_root": os.path.dirname(__file__) + "/media"}, name='cropduster-static'),
 	
 	url(r'^upload/', "cropduster.views.upload", name='cropduster-upload'),
+	
+	url(r'^chunks/$', "cropduster.views.upload_init", name='cropduster-upload-init'),
+	url(r'^chunks/(?P<upload_id>[0-9a-f]{32})/$', "cropduster.views.upload_chunk", name='cropduster-upload-chunk'),
+	url(r'^chunks/(?P<upload_id>[0-9a-f]{32})/finalize/$', "cropduster.views.upload_finalize", name='cropduster-upload-finalize'),
+	
+	url(r'^crops/$', "cropduster.views.crops", name='cropduster-crops'),
+	
+	url(r'^jobs/$', "cropduster.views.job_status", name='cropduster-job-status'),
+	
+	url(r'^thumbs/(?P<path>.+)$', "cropduster.views.thumbnail", name='cropduster-thumbnail'),
 )
@@ -1,5 +1,15 @@
+import hashlib
+import logging
+import math
+import os
+import threading
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+
 from PIL import Image
 
+from cropduster.settings import MIN_QUALITY, RESIZE_QUALITY_GUARD, RESIZE_THREADS
+
 
 def rescale(img, w=0, h=0, crop=True, **kwargs):
 	"""Rescale the given image, optionally cropping it to make sure the result image has the specified width and height."""
@@ -41,22 +51,328 @@ def rescale(img, w=0, h=0, crop=True, **kwargs):
 
 	return img
 
-def create_cropped_image(path=None, x=0, y=0, w=0, h=0):
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+def get_thread_pool():
+	""" Returns the thread pool shared by all thumbnail creation in this process """
+	global _pool, _pool_pid
+	_pool_lock.acquire()
+	try:
+		# A forked child doesn't get its parent's threads
+		if _pool is None or _pool_pid != os.getpid():
+			_pool, _pool_pid = ThreadPool(RESIZE_THREADS), os.getpid()
+		return _pool
+	finally:
+		_pool_lock.release()
+
+def map_threaded(func, items):
+	"""
+	Calls func on each of the items in the shared thread pool, returning the
+	results in order. Runs serially if CROPDUSTER_RESIZE_THREADS is 1 or less,
+	or there is only one item.
+	"""
+	if RESIZE_THREADS <= 1 or len(items) <= 1:
+		return map(func, items)
+	return get_thread_pool().map(func, items)
+
+def plan_chain(img_size, sizes, quality_guard=RESIZE_QUALITY_GUARD):
+	"""
+	Orders sizes (anything with width and height attributes) largest first,
+	and picks the source each is rescaled from: the smallest earlier size that
+	is at least quality_guard times its width and height, or the image itself
+	if there is none, so only the largest sizes pay for resampling the full
+	image. A size with only a width or a height keeps the image's aspect
+	ratio, so it is only rescaled from another such size or the image, never
+	from one that has been cropped or stretched to a fixed ratio.
+
+	@return: [(size, index of the source size in the list, or None), ...]
+	"""
+	img_width, img_height = img_size
+	plan = []
+	dimensions = []
+	for size in sorted(sizes, key=lambda size: (size.width or 0, size.height or 0), reverse=True):
+		w, h = size.width or 0, size.height or 0
+		free = not (w and h)
+		w = w or float(img_width * h) / img_height
+		h = h or float(img_height * w) / img_width
+
+		source = None
+		for i in reversed(range(len(dimensions))):
+			source_w, source_h, source_free = dimensions[i]
+			if free and not source_free:
+				continue
+			if source_w >= w * quality_guard and source_h >= h * quality_guard:
+				source = i
+				break
+
+		dimensions.append((int(w), int(h), free))
+		plan.append((size, source))
+	return plan
+
+def rescale_chain(img, sizes, crop=True, quality_guard=RESIZE_QUALITY_GUARD):
+	"""
+	Rescales the given image to each of the sizes, largest first, each from
+	the source picked by plan_chain.
+
+	Yields (size, thumbnail) tuples.
+	"""
+	rescaled = []
+	for size, source in plan_chain(img.size, sizes, quality_guard):
+		thumbnail = rescale(img if source is None else rescaled[source], size.width or 0, size.height or 0, crop=crop)
+		rescaled.append(thumbnail)
+		yield size, thumbnail
+
+def rescale_chains(chains, save, quality_guard=RESIZE_QUALITY_GUARD):
+	"""
+	Rescales several images to their sizes the way rescale_chain does, in the
+	shared pool of CROPDUSTER_RESIZE_THREADS threads. chains is a list of (img,
+	sizes, crop) tuples. Sizes are rescaled in rounds, each round taking every
+	size (of any chain) whose source is ready, and every thumbnail is handed
+	to save(size, thumbnail) in the thread that made it, so that encoding runs
+	in parallel too. Pillow releases the GIL for both.
+
+	@return: A list of [(size, thumbnail, what save returned), ...] for each
+	         chain, largest first
+	"""
+	tasks = []
+	spans = []
+	for img, sizes, crop in chains:
+		start = len(tasks)
+		spans.append((start, start + len(sizes)))
+		for size, source in plan_chain(img.size, sizes, quality_guard):
+			tasks.append((img, size, None if source is None else start + source, crop))
+
+	def run(i):
+		img, size, source, crop = tasks[i]
+		thumbnail = rescale(img if source is None else results[source], size.width or 0, size.height or 0, crop=crop)
+		return thumbnail, save(size, thumbnail)
+
+	results = [None] * len(tasks)
+	saved = [None] * len(tasks)
+	pending = range(len(tasks))
+	while pending:
+		ready = [i for i in pending if tasks[i][2] is None or results[tasks[i][2]] is not None]
+		for i, (thumbnail, result) in zip(ready, map_threaded(run, ready)):
+			results[i], saved[i] = thumbnail, result
+		pending = [i for i in pending if results[i] is None]
+
+	return [[(tasks[i][1], results[i], saved[i]) for i in range(start, end)] for start, end in spans]
+
+# Formats whose size depends on the quality they're saved at
+QUALITY_FORMATS = ("JPEG", "WEBP")
+
+def encode_within(img, format, max_bytes, min_quality=MIN_QUALITY, **params):
+	"""
+	Encodes an image at the highest quality, up to params["quality"], that
+	comes to no more than max_bytes, searching between that and min_quality
+	by bisection. If even min_quality comes to more, that is what is used.
+	Formats without a quality setting are encoded once, and have no quality.
+	A warning is logged when the image doesn't fit.
+
+	@return: (the encoded image as a string, quality or None)
+	"""
+	def encode(quality):
+		out = StringIO()
+		img.save(out, format, **dict(params, quality=quality))
+		return out.getvalue()
+
+	def too_large(data, reason):
+		logging.warning("Thumbnail of %i bytes is over its %i byte budget: %s" % (len(data), max_bytes, reason))
+
+	high = params.get("quality", 95)
+	data = encode(high)
+	if format not in QUALITY_FORMATS:
+		if len(data) > max_bytes:
+			too_large(data, "%s has no quality setting to lower" % format)
+		return data, None
+	if len(data) <= max_bytes:
+		return data, high
+	if high <= min_quality:
+		too_large(data, "its quality of %i is already the lowest allowed" % high)
+		return data, high
+
+	best = None
+	low, high = min_quality, high - 1
+	while low <= high:
+		quality = (low + high) // 2
+		data = encode(quality)
+		if len(data) <= max_bytes:
+			best = data, quality
+			low = quality + 1
+		else:
+			high = quality - 1
+
+	if best is None:
+		# The last attempt was min_quality
+		too_large(data, "even at the lowest quality allowed, %i" % min_quality)
+		return data, min_quality
+	return best
+
+def group_by_aspect_ratio(sizes):
+	"""
+	Splits sizes into lists of sizes with the same aspect ratio. Sizes with
+	only a width or a height (whose aspect_ratio is 1 regardless) take the
+	image's ratio, and are grouped together.
+	"""
+	groups = {}
+	for size in sizes:
+		ratio = size.aspect_ratio if size.width and size.height else None
+		groups.setdefault(ratio, []).append(size)
+	return groups.values()
+
+def open_image(path, box=None, min_width=0, min_height=0, quality_guard=RESIZE_QUALITY_GUARD):
+	"""
+	Opens and decodes the image at path, cropped to box (x, y, w, h) if one is
+	given. If the cropped area is at least twice as large as min_width x
+	min_height (times quality_guard, see rescale_chain), it is decoded at a
+	reduced scale (with JPEG draft mode, or Image.reduce where available)
+	that is still at least that large. The result keeps the format of the
+	original.
+	"""
+	img = Image.open(path)
+	format = img.format
+	x, y, w, h = box or ((0, 0) + img.size)
+
+	factors = []
+	if min_width > 0:
+		factors.append(float(w) / (min_width * quality_guard))
+	if min_height > 0:
+		factors.append(float(h) / (min_height * quality_guard))
+	factor = min(factors) if factors else 1
+
+	if factor >= 2 and format == "JPEG":
+		# draft picks the smallest DCT scale (1/2, 1/4, 1/8) at least this large
+		original_width, original_height = img.size
+		img.draft(img.mode, (int(math.ceil(original_width / factor)), int(math.ceil(original_height / factor))))
+		scale_x = float(img.size[0]) / original_width
+		scale_y = float(img.size[1]) / original_height
+		x, w = int(x * scale_x), int(math.ceil(w * scale_x))
+		y, h = int(y * scale_y), int(math.ceil(h * scale_y))
+		w, h = min(w, img.size[0] - x), min(h, img.size[1] - y)
+		factor = 1
+
+	img.load()
+	if factor >= 2 and hasattr(img, "reduce"):
+		try:
+			reduced = img.reduce(int(factor), box=(x, y, x + w, y + h))
+		except ValueError:
+			# Not every mode can be reduced
+			pass
+		else:
+			reduced.format = format
+			return reduced
+
+	if box:
+		img = img.crop((x, y, x + w, y + h))
+		img.load()
+		img.format = format
+	return img
+
+def create_cropped_image(path=None, x=0, y=0, w=0, h=0, min_width=0, min_height=0):
+	"""
+	Crops the image at path to (x, y, w, h). If min_width or min_height are
+	given, the crop may be decoded at a reduced scale that is still at least
+	that large (see open_image).
+	"""
 	if path is None:
 		raise ValueError("A path must be specified")
 	if w <= 0 or h <= 0:
 		raise ValueError("Width and height must be greater than zero")
 
-	img = Image.open(path)
-	img.copy()
-	img.load()
-	img = img.crop((x, y, x + w, y + h))
-	img.load()
-	return img
+	return open_image(path, (x, y, w, h), min_width, min_height)
+
+
+# Number of images the management commands look up and process at a time
+CHUNK_SIZE = 500
+
+def chunked(iterable, n):
+	""" Splits an iterable into lists of at most n items """
+	chunk = []
+	for item in iterable:
+		chunk.append(item)
+		if len(chunk) == n:
+			yield chunk
+			chunk = []
+	if chunk:
+		yield chunk
+
+def fingerprint(*values):
+	""" Returns a hash identifying the given values """
+	return hashlib.md5(repr(values)).hexdigest()
+
+def file_fingerprint(path):
+	""" Identifies the current version of a file by its modification time and size """
+	stat = os.stat(path)
+	return "%d-%d" % (stat.st_mtime, stat.st_size)
+
+
+def read_image_header(f):
+	"""
+	Reads an image's dimensions and format from its header, without decoding
+	it. Raises an exception if the file isn't an image PIL can open.
+
+	@return: (width, height, format)
+	"""
+	f.seek(0)
+	img = Image.open(f)
+	width, height = img.size
+	f.seek(0)
+	return width, height, img.format
+
+def image_file_info(f, block_size=1 << 20):
+	"""
+	Reads an image file's dimensions and format from its header, and hashes
+	its contents, without decoding it.
+
+	@return: (width, height, format, size in bytes, sha1 hex digest)
+	"""
+	f.seek(0)
+	img = Image.open(f)
+	width, height = img.size
+	format = img.format
+
+	f.seek(0)
+	sha1 = hashlib.sha1()
+	filesize = 0
+	for block in iter(lambda: f.read(block_size), ""):
+		sha1.update(block)
+		filesize += len(block)
+	f.seek(0)
+	return width, height, format, filesize, sha1.hexdigest()
+
+def fit_image(f, max_width, max_height, min_width=0, min_height=0, **save_params):
+	"""
+	Downscales the image in file f to fit within max_width x max_height,
+	keeping its aspect ratio and format, with one decode (at a reduced scale
+	where possible, see open_image) and one encode. It is never made narrower
+	than min_width or shorter than min_height, even if that means it doesn't
+	fit.
+
+	@return: The encoded image as a string, or None if it is left alone.
+	"""
+	width, height, format = read_image_header(f)
+	scale = max(min(float(max_width) / width, float(max_height) / height),
+		float(min_width) / width, float(min_height) / height)
+	if scale >= 1:
+		return None
+
+	w = max(1, min_width, int(width * scale))
+	h = max(1, min_height, int(height * scale))
+	img = rescale(open_image(f, min_width=w, min_height=h), w, h, crop=False)
 
+	out = StringIO()
+	img.save(out, format, **save_params)
+	f.seek(0)
+	return out.getvalue()
 
 def rescale_signal(sender, instance, created, max_height=None, max_width=None, **kwargs):
-	""" Simplified image resizer meant to work with post-save/pre-save tasks """
+	"""
+	Simplified image resizer meant to work with post-save/pre-save tasks.
+	Rewrites the stored file after it is saved; cropduster's own images are
+	capped before they are stored instead, see CROPDUSTER_CAP_ORIGINALS.
+	"""
 
 	max_width = max_width
 	max_height = max_height
@@ -0,0 +1,41 @@
+"""
+Version tokens kept in Django's cache framework, which tell a process that
+something it holds in memory was changed by another process.
+"""
+import uuid
+
+from django.core.cache import cache
+
+KEY_PREFIX = "cropduster.version."
+
+# Memcached's longest relative timeout
+TIMEOUT = 60 * 60 * 24 * 30
+
+
+def get_version(name):
+	"""
+	Returns the current version token for name, starting a new one if the
+	cache has none. With a cache that doesn't keep anything (the dummy
+	backend), every call returns a new token.
+	"""
+	key = KEY_PREFIX + name
+	version = cache.get(key)
+	if version is None:
+		version = uuid.uuid4().hex
+		cache.add(key, version, TIMEOUT)
+		version = cache.get(key) or version
+	return version
+
+def get_versions(*names):
+	""" Returns the version tokens for several names, with one cache lookup """
+	keys = [KEY_PREFIX + name for name in names]
+	versions = cache.get_many(keys)
+	return [versions.get(key) or get_version(name) for key, name in zip(keys, names)]
+
+def bump(name):
+	""" Gives name a new version token """
+	cache.set(KEY_PREFIX + name, uuid.uuid4().hex, TIMEOUT)
+
+def image_version(image_id):
+	""" Name of the version for an image and its crops """
+	return "image.%s" % image_id
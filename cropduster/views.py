@@ -1,24 +1,57 @@
+import math
 import os
-from django.http import HttpResponse, Http404
+from django.http import HttpResponse, HttpResponseNotAllowed, Http404
 from django.shortcuts import render_to_response
 from django.template import RequestContext
-from django.forms import TextInput
+from django.forms import FileField, TextInput
 from django.forms.widgets import Select
+from django.contrib.admin.views.decorators import staff_member_required
 from django.views.decorators.csrf import csrf_exempt
+from django.views.static import serve
+from django.utils import simplejson
 
-from cropduster.models import Image as CropDusterImage, Crop, Size, SizeSet
-from cropduster.settings import CROPDUSTER_MEDIA_ROOT
-
-from PIL import Image as pil
+from cropduster import chunked, jobs, utils
+from cropduster.models import Image as CropDusterImage, Crop, Size, Thumbnail
+from cropduster.registry import registry
+from cropduster.settings import CAP_ORIGINALS, CROPDUSTER_MEDIA_ROOT, MAX_UPLOAD_BYTES, \
+	MAX_UPLOAD_MEGAPIXELS, PREVIEW_WIDTH
 
 
 from django.forms import ModelForm, ValidationError
 
-BROWSER_WIDTH = 800
+BROWSER_WIDTH = PREVIEW_WIDTH
+
+
+class ImageHeaderField(FileField):
+	"""
+	An image upload field that only reads the image's header, and turns away
+	files over the byte or pixel budget before anything is decoded. The
+	upload's (width, height, format) is kept as its image_header.
+	"""
+	def to_python(self, data):
+		f = super(ImageHeaderField, self).to_python(data)
+		if f is None:
+			return None
+
+		if MAX_UPLOAD_BYTES and f.size > MAX_UPLOAD_BYTES:
+			raise ValidationError("Uploaded file is larger than %i MB" % (MAX_UPLOAD_BYTES / (1024 * 1024)))
+
+		try:
+			width, height, format = utils.read_image_header(f)
+		except Exception:
+			raise ValidationError("Unable to open image file")
+
+		if MAX_UPLOAD_MEGAPIXELS and width * height > MAX_UPLOAD_MEGAPIXELS * 1000000:
+			raise ValidationError("Uploaded image (%s x %s) is larger than %s megapixels" % (width, height, MAX_UPLOAD_MEGAPIXELS))
+
+		f.image_header = (width, height, format)
+		return f
 
 
 # Create the form class.
 class ImageForm(ModelForm):
+	image = ImageHeaderField(max_length=255)
+	
 	class Meta:
 		model = CropDusterImage
 	def clean(self):
@@ -26,19 +59,17 @@ class ImageForm(ModelForm):
 
 		image = self.cleaned_data.get("image")
 	
-		if image:
+		# Only new uploads need checking
+		if image and hasattr(image, "image_header"):
 		
 			if os.path.splitext(image.name)[1] == '':
 				raise ValidationError("Please make sure images have file extensions before uploading")
 		
-			try:
-				pil_image = pil.open(image)
-			except:
-				raise ValidationError("Unable to open image file")
-				
-			for size in size_set.size_set.all():
-				if not size.auto_size and (size.width > pil_image.size[0] or size.height > pil_image.size[1]):
-					raise ValidationError("Uploaded image (%s x %s) is smaller than a required thumbnail size: %s" % (pil_image.size[0], pil_image.size[1], size))
+			width, height, format = image.image_header
+			widest, tallest = registry.get_required_sizes(size_set.id)
+			for size in (widest, tallest):
+				if size and (size.width > width or size.height > height):
+					raise ValidationError("Uploaded image (%s x %s) is smaller than a required thumbnail size: %s" % (width, height, size))
 		return self.cleaned_data
 		
 		
@@ -57,12 +88,46 @@ class CropForm(ModelForm):
 			self._errors.clear()
 			raise ValidationError("Crop positions must be non-negative")
 		
+		# Checked in the original's pixels, as the crop is mapped back from
+		# the preview's
+		size = self.cleaned_data.get("size")
+		crop_w, crop_h = self.cleaned_data.get("crop_w"), self.cleaned_data.get("crop_h")
+		if size and crop_w is not None and crop_h is not None:
+			if crop_w < (size.width or 0) or crop_h < (size.height or 0):
+				raise ValidationError("Crop (%s x %s) is smaller than the thumbnail size: %s" % (crop_w, crop_h, size))
+		
 		return self.cleaned_data
-	
+
+
+def scale_crop_data(data, image):
+	"""
+	Maps the crop posted from the admin, in the preview's pixels, to the
+	original's pixels. data is a mutable copy of the POST.
+	"""
+	scale = image.preview_scale
+	if scale == 1:
+		return data
+	try:
+		x, y, w, h = [int(data[name]) for name in ("crop_x", "crop_y", "crop_w", "crop_h")]
+	except (KeyError, ValueError):
+		# Left for CropForm to complain about
+		return data
+	x, y = int(round(x * scale)), int(round(y * scale))
+	w = min(int(round(w * scale)), image.width - x)
+	h = min(int(round(h * scale)), image.height - y)
+	data["crop_x"], data["crop_y"], data["crop_w"], data["crop_h"] = x, y, w, h
+	return data
+
+
 @csrf_exempt
 def upload(request):
 	
-	size_set = SizeSet.objects.get(id=request.GET["size_set"])
+	try:
+		size_set = registry.get_size_set(int(request.GET["size_set"]))
+	except ValueError:
+		size_set = None
+	if size_set is None:
+		raise Http404
 	
 	# Get the current aspect ratio
 	if "aspect_ratio_id" in request.POST:
@@ -80,7 +145,8 @@ def upload(request):
 	
 
 	
-	size = Size.objects.get_size_by_ratio(size_set.id, aspect_ratio_id) or Size()
+	step = registry.get_crop_step(size_set.id, aspect_ratio_id)
+	size = step.size if step else Size()
 	
 
 	# Get the current crop
@@ -105,6 +171,7 @@ def upload(request):
 			
 			if formset.is_valid():
 				image = formset.save()
+				image.create_preview()
 				crop.image = image
 				crop_formset = CropForm(instance=crop)
 			else:
@@ -137,16 +204,24 @@ def upload(request):
 			if size.id:
 				
 				# Lets save the crop
-				request.POST['size'] = size.id
-				request.POST['image'] = image.id
-				crop_formset = CropForm(request.POST, instance=crop)
+				data = scale_crop_data(request.POST.copy(), image)
+				data['size'] = size.id
+				data['image'] = image.id
+				crop_formset = CropForm(data, instance=crop)
 				
 				if crop_formset.is_valid():
-					crop = crop_formset.save()
+					# One job for all the crops saved so far, so their thumbnails
+					# are made even if the rest of the crops never are; it only
+					# makes those that are out of date, decoding the original
+					# once. The database backend reuses a job that is waiting.
+					crop = crop_formset.save(commit=False)
+					crop.save(create_thumbnails=False)
+					jobs.enqueue(jobs.CROPS, image.id, image.id)
 					
 					#Now get the next crop if it exists
 					aspect_ratio_id = aspect_ratio_id + 1
-					size = Size.objects.get_size_by_ratio(size_set, aspect_ratio_id)
+					step = registry.get_crop_step(size_set.id, aspect_ratio_id)
+					size = step and step.size
 					
 					# If there's another crop
 					if size:
@@ -174,6 +249,21 @@ def upload(request):
 		crop_w = crop.crop_w or size.width
 		crop_h = crop.crop_h or size.height
 		
+		# The file's details are only stored once it has been read
+		image_exists = image.image and (image.sha1 or os.path.exists(image.image.path))
+		
+		# The crop is made on a reduced copy of the original, and the crop
+		# values posted are mapped back to the original's pixels
+		scale = image.preview_scale if image_exists else 1.0
+		if scale != 1 and not os.path.exists(image.preview_path):
+			image.create_preview()
+		def to_preview(value):
+			return int(round((value or 0) / scale))
+		def to_preview_min(value):
+			# Rounded up, so the smallest crop allowed in the preview still
+			# covers the size in the original
+			return int(math.ceil((value or 0) / scale))
+		
 		# Combine errors from both forms, eliminate duplicates
 		errors = dict(crop_formset.errors)
 		errors.update(formset.errors)
@@ -188,17 +278,20 @@ def upload(request):
 			"aspect_ratio_id": aspect_ratio_id,	
 			"browser_width": BROWSER_WIDTH,
 			"crop_formset": crop_formset,
-			"crop_w" : crop_w,
-			"crop_h" : crop_h,
-			"crop_x" : crop.crop_x or 0,
-			"crop_y" : crop.crop_y or 0,
+			"crop_w" : to_preview(crop_w),
+			"crop_h" : to_preview(crop_h),
+			"crop_x" : to_preview(crop.crop_x),
+			"crop_y" : to_preview(crop.crop_y),
 			"errors" : all_errors,
 			"formset": formset,
 			"image": image,
 			"image_element_id" : request.GET["image_element_id"],
-			"image_exists": image.image and os.path.exists(image.image.path),
+			"image_exists": image_exists,
 			"min_w"  : size.width,
 			"min_h"  : size.height,
+			"preview_min_w": to_preview_min(size.width),
+			"preview_min_h": to_preview_min(size.height),
+			"preview_url": image.preview_url if image_exists else "",
 
 		}
 		
@@ -208,15 +301,267 @@ def upload(request):
 
 	# No more cropping to be done, close out
 	else :
-		image_thumbs = [image.thumbnail_url(size.slug) for size in image.size_set.get_size_by_ratio()] 
+		image_thumbs = [image.thumbnail_url(size.slug) for size in registry.get_sizes_by_ratio(image.size_set_id)]
 	
 		context = {
 			"image": image,
 			"image_thumbs": image_thumbs,
+			"pending_jobs": jobs.pending(image.id),
 			"image_element_id" : request.GET["image_element_id"]
 		}
 		
 		context = RequestContext(request, context)
 		return render_to_response("admin/complete.html", context)
-		
 
+
+def thumbnail(request, path):
+	"""
+	Creates a thumbnail the first time it is requested, then serves it.
+
+	``path`` is the thumbnail's url relative to MEDIA_URL (that is, the path
+	of the original without its extension, followed by the size slug and
+	the extension of the original, or of the format set by the size's
+	encoding profile). The web server should only pass requests
+	through to this view for files that don't exist yet; once written,
+	the thumbnail is served statically. A thumbnail is created here if the
+	inventory has no record of it, or it turns out to be missing.
+	"""
+	folder, file_name = os.path.split(path)
+	size_slug, extension = os.path.splitext(file_name)
+
+	try:
+		image = CropDusterImage.objects.get(image=folder + extension)
+	except CropDusterImage.DoesNotExist:
+		# Sizes with an encoding profile that changes the format have another
+		# extension than the original
+		for image in CropDusterImage.objects.filter(image__startswith=folder + "."):
+			if os.path.splitext(image.image.name)[0] == folder:
+				break
+		else:
+			raise Http404
+	size = registry.get_size(image.size_set_id, size_slug)
+	if size is None or not image.thumbnail_path(size).endswith(extension):
+		raise Http404
+
+	thumbnail_path = image.thumbnail_path(size)
+	recorded = Thumbnail.objects.filter(image=image, size=size).exclude(path="").exists()
+	if not recorded:
+		image.create_thumbnail(size)
+
+	try:
+		return serve(request, os.path.basename(thumbnail_path), document_root=os.path.dirname(thumbnail_path))
+	except Http404:
+		if not recorded:
+			raise
+		image.create_thumbnail(size)
+		return serve(request, os.path.basename(thumbnail_path), document_root=os.path.dirname(thumbnail_path))
+
+
+def job_status(request):
+	"""
+	Reports on thumbnail jobs as JSON: the status of the job given by job_id,
+	or the number of unfinished jobs for the image given by image_id.
+	"""
+	if "job_id" in request.GET:
+		status = jobs.status(request.GET["job_id"])
+		if status is None:
+			raise Http404
+		data = {"status": status}
+	elif "image_id" in request.GET:
+		try:
+			data = {"pending": jobs.pending(int(request.GET["image_id"]))}
+		except ValueError:
+			raise Http404
+	else:
+		raise Http404
+
+	return HttpResponse(simplejson.dumps(data), mimetype="application/json")
+
+
+def json_response(data, status=200):
+	response = HttpResponse(simplejson.dumps(data), mimetype="application/json")
+	response.status_code = status
+	return response
+
+
+def clean_crops(image, data):
+	"""
+	Validates a list of crops for an image, each a dict with the index of its
+	step in the size set's crop plan (aspect_ratio_id) and its crop_x, crop_y,
+	crop_w and crop_h in the original's pixels.
+
+	Returns the crop plan step and box of each crop, and a list of errors.
+	"""
+	cleaned = []
+	errors = []
+	seen = set()
+	if not isinstance(data, list):
+		return cleaned, ["crops must be a list"]
+
+	for i, values in enumerate(data):
+		try:
+			aspect_ratio_id = int(values["aspect_ratio_id"])
+			box = tuple(int(values[name]) for name in ("crop_x", "crop_y", "crop_w", "crop_h"))
+		except (KeyError, TypeError, ValueError):
+			errors.append("Crop %i: aspect_ratio_id, crop_x, crop_y, crop_w and crop_h must be integers" % i)
+			continue
+
+		step = registry.get_crop_step(image.size_set_id, aspect_ratio_id)
+		x, y, w, h = box
+		if step is None:
+			errors.append("Crop %i: no aspect ratio %i to crop" % (i, aspect_ratio_id))
+		elif aspect_ratio_id in seen:
+			errors.append("Crop %i: aspect ratio %i is cropped twice" % (i, aspect_ratio_id))
+		elif w <= 0 or h <= 0:
+			errors.append("Crop %i: crop_w and crop_h must be positive" % i)
+		elif x < 0 or y < 0:
+			errors.append("Crop %i: crop positions must be non-negative" % i)
+		elif x + w > image.width or y + h > image.height:
+			errors.append("Crop %i: crop extends past the image (%s x %s)" % (i, image.width, image.height))
+		elif w < step.size.width or h < step.size.height:
+			errors.append("Crop %i: crop is smaller than %s" % (i, step.size))
+		else:
+			cleaned.append((step, box))
+		seen.add(aspect_ratio_id)
+	return cleaned, errors
+
+
+@staff_member_required
+def crops(request):
+	"""
+	Saves all of an image's crops in one request, and creates the thumbnails
+	for them together, decoding the original once. Takes a JSON object:
+
+		{"image_id": 1, "crops": [{"aspect_ratio_id": 0, "crop_x": 0, "crop_y": 0,
+			"crop_w": 400, "crop_h": 300}, ...]}
+
+	where aspect_ratio_id is the step of the size set's crop plan, as in the
+	upload wizard. Nothing is saved unless every crop is valid. Responds with
+	the thumbnail job's id and the ids of the saved crops, or with the errors.
+	"""
+	if request.method != "POST":
+		return HttpResponseNotAllowed(["POST"])
+
+	try:
+		data = simplejson.loads(request.raw_post_data)
+		image = CropDusterImage.objects.get(id=int(data["image_id"]))
+	except (ValueError, KeyError, TypeError):
+		return json_response({"errors": ["Expected a JSON object with an image_id and crops"]}, status=400)
+	except CropDusterImage.DoesNotExist:
+		raise Http404
+
+	try:
+		image.ensure_dimensions()
+	except (IOError, OSError):
+		return json_response({"errors": ["The image's file can't be read"]}, status=409)
+
+	cleaned, errors = clean_crops(image, data.get("crops"))
+	if errors:
+		return json_response({"errors": errors}, status=400)
+
+	existing = dict((crop.size_id, crop) for crop in Crop.objects.filter(image=image))
+	saved = []
+	for step, (x, y, w, h) in cleaned:
+		crop = existing.get(step.size.id) or Crop(image=image, size=step.size)
+		crop.crop_x, crop.crop_y, crop.crop_w, crop.crop_h = x, y, w, h
+		crop.save(create_thumbnails=False)
+		saved.append({"id": crop.id, "size": step.size.slug})
+
+	job_id = jobs.enqueue(jobs.CROPS, image.id, image.id) if saved else None
+	return json_response({
+		"job_id": job_id,
+		"crops": saved,
+	})
+
+
+@staff_member_required
+def upload_init(request):
+	"""
+	Starts a chunked upload of an original. Takes the file's name and size in
+	bytes, and the size_set, attribution and caption of the image to create
+	from it. Responds with the upload's id.
+	"""
+	if request.method != "POST":
+		return HttpResponseNotAllowed(["POST"])
+
+	try:
+		size = int(request.POST.get("size", 0))
+	except ValueError:
+		size = 0
+	try:
+		upload_id = chunked.init(os.path.basename(request.POST.get("name", "")), size,
+			size_set=request.POST.get("size_set"),
+			attribution=request.POST.get("attribution", ""),
+			caption=request.POST.get("caption", ""))
+	except chunked.UploadError, e:
+		return json_response({"errors": [str(e)]}, status=400)
+	return json_response({"upload_id": upload_id, "offset": 0})
+
+
+@staff_member_required
+def upload_chunk(request, upload_id):
+	"""
+	GET gives how many bytes of the upload have been received. POST appends
+	the request body to it, if the offset given matches; otherwise responds
+	with a 409 and the offset to resume from.
+	"""
+	if chunked.get_info(upload_id) is None:
+		raise Http404
+	if request.method == "GET":
+		return json_response({"offset": chunked.get_offset(upload_id)})
+	if request.method != "POST":
+		return HttpResponseNotAllowed(["GET", "POST"])
+
+	try:
+		offset = int(request.GET["offset"])
+		length = int(request.META.get("CONTENT_LENGTH") or 0)
+	except (KeyError, ValueError):
+		return json_response({"errors": ["Expected the offset of the chunk"]}, status=400)
+
+	try:
+		offset = chunked.append(upload_id, offset, request, length)
+	except chunked.UploadError, e:
+		return json_response({"errors": [str(e)], "offset": chunked.get_offset(upload_id)}, status=409)
+	return json_response({"offset": offset})
+
+
+@staff_member_required
+def upload_finalize(request, upload_id):
+	"""
+	Creates the image from a complete chunked upload. Unless originals are
+	capped, storage moves the file into place rather than copying it.
+	Responds with the image's id and url, or with the form's errors.
+	"""
+	if request.method != "POST":
+		return HttpResponseNotAllowed(["POST"])
+	info = chunked.get_info(upload_id)
+	if info is None:
+		raise Http404
+
+	try:
+		upload = chunked.get_file(upload_id)
+	except chunked.UploadError, e:
+		return json_response({"errors": [str(e)], "offset": chunked.get_offset(upload_id)}, status=409)
+
+	try:
+		formset = ImageForm({
+			"size_set": info["size_set"],
+			"attribution": info["attribution"],
+			"caption": info["caption"],
+		}, {"image": upload})
+		if not formset.is_valid():
+			errors = [u"%s: %s" % (field.capitalize(), error.as_text()) for field, error in formset.errors.items()]
+			return json_response({"errors": errors}, status=400)
+
+		image = formset.save(commit=False)
+		if not CAP_ORIGINALS:
+			# Committed here, as the field would hand storage its own wrapper
+			# of the upload, which storage copies
+			image.image.save(upload.name, upload, save=False)
+		image.save()
+		image.create_preview()
+	finally:
+		upload.close()
+		chunked.remove(upload_id)
+
+	return json_response({"image_id": image.id, "url": image.image.url, "pending_jobs": jobs.pending(image.id)})
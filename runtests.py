@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""
+Runs cropduster's tests against an in-memory sqlite database, with media and
+chunked uploads kept in a temporary directory:
+
+	python runtests.py
+"""
+import os
+import sys
+import shutil
+import tempfile
+
+from django.conf import settings
+
+
+def runtests():
+	media_root = tempfile.mkdtemp()
+	if not settings.configured:
+		settings.configure(
+			DATABASES={
+				"default": {
+					"ENGINE": "django.db.backends.sqlite3",
+					"NAME": ":memory:",
+				},
+			},
+			INSTALLED_APPS=(
+				"django.contrib.auth",
+				"django.contrib.contenttypes",
+				"django.contrib.sessions",
+				"django.contrib.admin",
+				"cropduster",
+			),
+			ROOT_URLCONF="cropduster.urls",
+			MEDIA_ROOT=media_root,
+			MEDIA_URL="/media/",
+			STATIC_URL="/static/",
+			CROPDUSTER_UPLOAD_PATH="cropduster/",
+			CROPDUSTER_CHUNKED_UPLOAD_DIR=os.path.join(media_root, "chunks"),
+			CROPDUSTER_LOCK_DIR=os.path.join(media_root, "locks"),
+		)
+
+	from django.test.simple import DjangoTestSuiteRunner
+	try:
+		failures = DjangoTestSuiteRunner(verbosity=1, interactive=False).run_tests(["cropduster"])
+	finally:
+		shutil.rmtree(media_root)
+	sys.exit(failures)
+
+
+if __name__ == "__main__":
+	runtests()